@@ -1,51 +1,393 @@
 import os.path
-import base64
+import array
+import fnmatch
+import importlib
+import collections
+import concurrent.futures
+import difflib
+import hashlib
+import itertools
+import re
+import shutil
+import json
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
 
 import pygments
-from pygments.lexers import PythonLexer
+from pygments.lexers import TextLexer
+# Private, but the only way to list the lexers without importing them all, so
+# check it still has the same layout when upgrading the pinned pygments.
+from pygments.lexers._mapping import LEXERS
+from pygments.token import string_to_tokentype
 from pygments.formatters import HtmlFormatter
 
+import sqlite3
+
 import requests
+import requests.adapters
 
 
 class CodeHtmlFormatter(HtmlFormatter):
-    def __init__(self, *args, output_filename=None, **kwargs):
+    def __init__(self, *args, output_filename=None, annotation_html=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.output_filename = output_filename
+        # Maps a line number to the (already rendered) html of the annotations
+        # which should be placed before that line.
+        self.annotation_html = annotation_html or {}
 
     def wrap(self, source, outfile):
         return self._wrap_pre_code(source)
 
-    def _wrap_pre_code(self, source):
-        for line_number, (is_code, source_line) in enumerate(source):
+    def highlight_lines(self, tokensource):
+        """Returns the highlighted html of each line without any wrapping, this
+        is what we cache, and can later be passed to `wrap_lines`."""
+        return [line for _is_code, line in self._format_lines(tokensource)]
+
+    def wrap_lines(self, lines, first_line_number=0, annotation_html=None):
+        """Wraps each of the given highlighted lines, merging in the annotations
+        as we go. Returns the html for all of the given lines, which need not
+        start at the beginning of the file. Passing the annotations here rather
+        than to the constructor allows one formatter to be shared."""
+        source = ((1, line) for line in lines)
+        wrapped = self._wrap_pre_code(source, first_line_number=first_line_number,
+                                      annotation_html=annotation_html)
+        return ''.join(line for _is_code, line in wrapped)
+
+    def _wrap_pre_code(self, source, first_line_number=0, annotation_html=None):
+        if annotation_html is None:
+            annotation_html = self.annotation_html
+        for line_number, (is_code, source_line) in enumerate(source, first_line_number):
             if is_code == 1:
-                source_line = """<pre id="code-line-{0}" class="code-line-container"
-                   ><code class="code-line">{1}</code></pre>""".format(line_number, source_line)
+                source_line = """{2}<pre id="code-line-{0}" class="code-line-container"
+                   ><code class="code-line">{1}</code></pre>""".format(
+                       line_number, source_line,
+                       annotation_html.get(line_number, ''))
             yield is_code, source_line
 
 
 import click
 import jinja2
+import markdown
+import markdown.treeprocessors
+import markupsafe
 
 @click.group()
 def appraisal():
     pass
 
 
-@appraisal.command()
-@click.argument('input_filename')
-@click.argument('output_filename')
-def highlight(input_filename, output_filename):
-    with open(input_filename, 'r') as source_file:
-        source_code = source_file.read()
-    source = SourceCode(input_filename, source_code=source_code)
-    env = jinja2.Environment(
-        loader=jinja2.PackageLoader('main', 'templates/'),
-        autoescape=jinja2.select_autoescape(['html', 'xml'])
+# Bump this whenever the static html changes, so that everything is rebuilt.
+static_format_version = 1
+static_environment = None
+
+def static_template(name):
+    """The templates for static html are rendered outside of the application,
+    so they have an environment of their own, created once per process."""
+    global static_environment
+    if static_environment is None:
+        basedir = os.path.abspath(os.path.dirname(__file__))
+        static_environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(os.path.join(basedir, 'templates/')),
+            autoescape=jinja2.select_autoescape(['html', 'xml', 'jinja'])
+            )
+    return static_environment.get_template(name)
+
+class LexerRegistry(object):
+    """Finds the lexer for a file from its name alone. Pygments can do this
+    itself, but it tries every pattern of every lexer each time and settles
+    ties by loading the candidates and running their `analyse_text`. Instead
+    we build a table once, from pygments' own mapping, and settle the few
+    ties with `preferred`. Lexer instances are stateless once created, so we
+    also keep one of each to share rather than creating one per file."""
+    preferred = {
+        '.h': 'CLexer',
+        '.html': 'HtmlLexer',
+        '.inc': 'PhpLexer',
+        '.j2': 'HtmlDjangoLexer',
+        '.jinja': 'HtmlDjangoLexer',
+        '.jinja2': 'HtmlDjangoLexer',
+        '.m': 'ObjectiveCLexer',
+        '.pl': 'PerlLexer',
+        '.r': 'SLexer',
+        '.s': 'GasLexer',
+        '.sql': 'SqlLexer',
+        '.ts': 'TypeScriptLexer',
+        '.txt': 'TextLexer',
+        '.xml': 'XmlLexer',
+        }
+    # Generated files of very long lines, not worth tokenizing.
+    minified_patterns = ['*.min.js', '*.min.css', '*.map']
+    minified_sample_size = 64 * 1024
+    minified_line_length = 500
+
+    def __init__(self):
+        self.extensions = {}
+        self.filenames = {}
+        self.patterns = []
+        for class_name, (_module, _name, _aliases, patterns, _mimetypes) in sorted(LEXERS.items()):
+            for pattern in patterns:
+                extension = pattern[1:]
+                if pattern.startswith('*.') and not any(c in extension for c in '*?['):
+                    self.extensions.setdefault(extension, class_name)
+                elif not any(c in pattern for c in '*?['):
+                    self.filenames.setdefault(pattern, class_name)
+                else:
+                    self.patterns.append((pattern, class_name))
+        self.extensions.update(self.preferred)
+        self._classes = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def lexer_class(self, filename, source_code=None):
+        """The lexer class for the named file, `TextLexer` if we do not know
+        one, or if the source looks minified."""
+        if self.is_minified(filename, source_code):
+            return TextLexer
+        basename = os.path.basename(filename)
+        class_name = self.filenames.get(basename)
+        if class_name is None:
+            _root, extension = os.path.splitext(basename)
+            class_name = self.extensions.get(extension.lower())
+        if class_name is None:
+            for pattern, pattern_class_name in self.patterns:
+                if fnmatch.fnmatch(basename, pattern):
+                    class_name = pattern_class_name
+                    break
+        if class_name is None:
+            return TextLexer
+        return self._load_class(class_name)
+
+    def _load_class(self, class_name):
+        lexer_class = self._classes.get(class_name)
+        if lexer_class is None:
+            module_name = LEXERS[class_name][0]
+            lexer_class = getattr(importlib.import_module(module_name), class_name)
+            self._classes[class_name] = lexer_class
+        return lexer_class
+
+    def is_minified(self, filename, source_code):
+        basename = os.path.basename(filename)
+        if any(fnmatch.fnmatch(basename, pattern) for pattern in self.minified_patterns):
+            return True
+        if not source_code:
+            return False
+        sample = source_code[:self.minified_sample_size]
+        newline = b'\n' if isinstance(sample, bytes) else '\n'
+        return len(sample) / (sample.count(newline) + 1) > self.minified_line_length
+
+    def lexer(self, lexer_class):
+        """A shared instance of the given lexer class."""
+        lexer = self._instances.get(lexer_class)
+        if lexer is None:
+            with self._lock:
+                lexer = self._instances.setdefault(lexer_class, lexer_class())
+        return lexer
+
+lexer_registry = LexerRegistry()
+
+def lex_source(source_code, lexer_class, time_budget=None, fallback=True):
+    """The `HighlightedLines` of the source. Plain text is split into lines
+    directly, without going through pygments at all. If lexing takes longer
+    than `time_budget` seconds we give up and treat the source as plain, or
+    raise `HighlightTimeout` if not `fallback`."""
+    if lexer_class is not TextLexer:
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        tokens = pygments.lex(source_code, lexer_registry.lexer(lexer_class))
+        try:
+            return HighlightedLines.from_tokens(tokens, deadline=deadline)
+        except HighlightTimeout:
+            if not fallback:
+                raise
+    if isinstance(source_code, bytes):
+        source_code = source_code.decode('utf-8', errors='replace')
+    return HighlightedLines.plain(source_code)
+
+def blob_hash(contents):
+    """The same hash git gives the contents, so that files read from disk and
+    blobs read from a git revision can be compared."""
+    header = 'blob {}\0'.format(len(contents)).encode('ascii')
+    return hashlib.sha1(header + contents).hexdigest()
+
+def is_binary(contents):
+    return b'\0' in contents[:8000]
+
+def render_static_file(job):
+    """Highlights one file into a standalone html page. This is run in the
+    worker processes of the `highlight` command, so it takes a single
+    picklable argument, (path, contents, output filename)."""
+    path, contents, output_filename = job
+    source_code = contents.decode('utf-8', errors='replace')
+    highlighted = lex_source(source_code, lexer_registry.lexer_class(path, source_code))
+    formatter = SourceCode.formatter
+    lines = highlighted.html_lines(0, len(highlighted), formatter)
+    html = static_template('static-source.jinja').render(
+        path=path,
+        style_defs=markupsafe.Markup(formatter.get_style_defs('.code-line')),
+        highlighted_source=markupsafe.Markup(formatter.wrap_lines(lines))
         )
-    template = env.get_template('view-source.jinja')
-    with open(output_filename, 'w') as outfile:
-        outfile.write(template.render(source=source))
+    os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+    with open(output_filename, 'w', encoding='utf-8') as output_file:
+        output_file.write(html)
+    return path
+
+def directory_sources(directory, exclude, unchanged):
+    """(path, contents hash, contents) for each file under the directory,
+    skipping git metadata and the `exclude` directory. The contents are None
+    if `unchanged(path, contents hash)` says that we need not read them."""
+    exclude = os.path.abspath(exclude)
+    for dirname, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs
+                         if d != '.git' and os.path.abspath(os.path.join(dirname, d)) != exclude)
+        for filename in sorted(files):
+            filename = os.path.join(dirname, filename)
+            with open(filename, 'rb') as source_file:
+                contents = source_file.read()
+            path = os.path.relpath(filename, directory).replace(os.sep, '/')
+            content_hash = blob_hash(contents)
+            yield path, content_hash, None if unchanged(path, content_hash) else contents
+
+def read_blobs(repository, shas):
+    """The contents of each of the given blobs, read with a single git
+    process."""
+    if not shas:
+        return {}
+    output = subprocess.run(
+        ['git', '-C', repository, 'cat-file', '--batch'],
+        input=''.join(sha + '\n' for sha in shas).encode('ascii'),
+        stdout=subprocess.PIPE, check=True).stdout
+    blobs = {}
+    offset = 0
+    for sha in shas:
+        header_end = output.index(b'\n', offset)
+        _sha, _type, size = output[offset:header_end].split()
+        start = header_end + 1
+        blobs[sha] = output[start:start + int(size)]
+        # Each blob is followed by a newline.
+        offset = start + int(size) + 1
+    return blobs
+
+def revision_sources(repository, revision, unchanged, chunk_size=256):
+    """As `directory_sources` but for the files of a git revision. We already
+    know the hash of every blob so only the changed ones are ever read, a
+    chunk at a time. We do not keep a git process open between chunks as
+    that would be inherited by the worker processes forked meanwhile."""
+    listing = subprocess.run(
+        ['git', '-C', repository, 'ls-tree', '-r', '-z', revision],
+        stdout=subprocess.PIPE, check=True).stdout
+    blobs = []
+    for record in listing.split(b'\0'):
+        if not record:
+            continue
+        info, path = record.split(b'\t', 1)
+        _mode, object_type, sha = info.decode('ascii').split()
+        if object_type == 'blob':
+            blobs.append((path.decode('utf-8'), sha))
+    for start in range(0, len(blobs), chunk_size):
+        chunk = blobs[start:start + chunk_size]
+        changed = [sha for path, sha in chunk if not unchanged(path, sha)]
+        contents = read_blobs(repository, changed)
+        for path, sha in chunk:
+            yield path, sha, contents.get(sha)
+
+def read_manifest(filename):
+    """The (files, skipped) of the last run, each mapping a path to the hash of
+    its contents, `files` are those rendered and `skipped` those which were
+    not, as they are binary."""
+    try:
+        with open(filename, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return {}, {}
+    if manifest.get('version') != static_format_version:
+        return {}, {}
+    return manifest['files'], manifest.get('skipped', {})
+
+def write_manifest(filename, files, skipped):
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as manifest_file:
+        json.dump({'version': static_format_version, 'files': files, 'skipped': skipped},
+                  manifest_file)
+    os.replace(temp_filename, filename)
+
+@appraisal.command()
+@click.argument('source')
+@click.argument('output')
+@click.option('--revision', default=None,
+              help="Highlight the files of this revision of the git repository SOURCE.")
+@click.option('--jobs', default=None, type=int,
+              help="Number of worker processes, defaults to the number of cores.")
+def highlight(source, output, revision, jobs):
+    """Highlight source code into static html. If SOURCE is a single file then
+    OUTPUT is the html file to write, otherwise every file under the directory
+    SOURCE (or in the given git revision of it) is highlighted into the
+    directory OUTPUT, along with an index. Files whose contents are unchanged
+    since the last run into OUTPUT are skipped."""
+    if revision is None and os.path.isfile(source):
+        with open(source, 'rb') as source_file:
+            contents = source_file.read()
+        render_static_file((os.path.basename(source), contents, output))
+        return
+
+    os.makedirs(output, exist_ok=True)
+    manifest_filename = os.path.join(output, '.highlight-manifest.json')
+    previous, previous_skipped = read_manifest(manifest_filename)
+    current = {}
+    skipped = {}
+    rendered = 0
+
+    def output_filename(path):
+        return os.path.join(output, path + '.html')
+
+    def unchanged(path, content_hash):
+        if previous_skipped.get(path) == content_hash:
+            return True
+        return (previous.get(path) == content_hash and
+                os.path.exists(output_filename(path)))
+
+    if revision is None:
+        sources = directory_sources(source, exclude=output, unchanged=unchanged)
+    else:
+        sources = revision_sources(source, revision, unchanged=unchanged)
+    jobs = jobs or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # Only keep a bounded number of files (and their contents) in flight.
+        pending = collections.deque()
+        for path, content_hash, contents in sources:
+            if contents is None:
+                if previous_skipped.get(path) == content_hash:
+                    skipped[path] = content_hash
+                else:
+                    current[path] = content_hash
+                continue
+            if is_binary(contents):
+                skipped[path] = content_hash
+                continue
+            job = (path, contents, output_filename(path))
+            pending.append((path, content_hash, executor.submit(render_static_file, job)))
+            rendered += 1
+            while len(pending) > jobs * 4:
+                done_path, done_hash, future = pending.popleft()
+                future.result()
+                current[done_path] = done_hash
+        for done_path, done_hash, future in pending:
+            future.result()
+            current[done_path] = done_hash
+    for path in set(previous) - set(current):
+        try:
+            os.remove(output_filename(path))
+        except FileNotFoundError:
+            pass
+    title = os.path.basename(os.path.abspath(source))
+    with open(os.path.join(output, 'index.html'), 'w', encoding='utf-8') as index_file:
+        index_file.write(static_template('static-index.jinja').render(
+            title=title, paths=sorted(current)))
+    write_manifest(manifest_filename, current, skipped)
+    click.echo('Highlighted {} of {} files into {}'.format(
+        rendered, len(current), output))
 
 def generated_file_path(additional_path):
     basedir = os.path.abspath(os.path.dirname(__file__))
@@ -54,31 +396,327 @@ def generated_file_path(additional_path):
 
 from pony import orm
 
+def migrate_line_numbers_to_integers(connection):
+    """Line numbers used to be stored as the id of the code line element,
+    'code-line-N', they are now stored as the integer N."""
+    connection.execute('''
+        CREATE TABLE "Annotation_new" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "repo" TEXT NOT NULL,
+            "repo_owner" TEXT NOT NULL,
+            "filepath" TEXT NOT NULL,
+            "line_number" INTEGER NOT NULL,
+            "content" TEXT NOT NULL
+            )''')
+    connection.execute('''
+        INSERT INTO "Annotation_new"
+            ("id", "repo", "repo_owner", "filepath", "line_number", "content")
+        SELECT "id", "repo", "repo_owner", "filepath",
+               CAST(REPLACE("line_number", 'code-line-', '') AS INTEGER),
+               "content"
+        FROM "Annotation"''')
+    connection.execute('DROP TABLE "Annotation"')
+    connection.execute('ALTER TABLE "Annotation_new" RENAME TO "Annotation"')
+
+def migrate_to_repository_and_source_file_entities(connection):
+    """Rather than each annotation repeating the repository owner, name and
+    file path, those now live in their own tables and the annotation refers to
+    the source file by id."""
+    connection.execute('''
+        CREATE TABLE "Repository" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "owner" TEXT NOT NULL,
+            "name" TEXT NOT NULL,
+            CONSTRAINT "unq_repository__owner_name" UNIQUE ("owner", "name")
+            )''')
+    connection.execute('''
+        INSERT INTO "Repository" ("owner", "name")
+        SELECT DISTINCT "repo_owner", "repo" FROM "Annotation"''')
+    connection.execute('''
+        CREATE TABLE "SourceFile" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "repository" INTEGER NOT NULL REFERENCES "Repository" ("id") ON DELETE CASCADE,
+            "path" TEXT NOT NULL,
+            CONSTRAINT "unq_sourcefile__repository_path" UNIQUE ("repository", "path")
+            )''')
+    connection.execute('''
+        INSERT INTO "SourceFile" ("repository", "path")
+        SELECT DISTINCT r."id", a."filepath"
+        FROM "Annotation" a
+        JOIN "Repository" r ON r."owner" = a."repo_owner" AND r."name" = a."repo"''')
+    connection.execute('''
+        CREATE TABLE "Annotation_new" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "source_file" INTEGER NOT NULL REFERENCES "SourceFile" ("id") ON DELETE CASCADE,
+            "line_number" INTEGER NOT NULL,
+            "content" TEXT NOT NULL
+            )''')
+    connection.execute('''
+        INSERT INTO "Annotation_new" ("id", "source_file", "line_number", "content")
+        SELECT a."id", f."id", a."line_number", a."content"
+        FROM "Annotation" a
+        JOIN "Repository" r ON r."owner" = a."repo_owner" AND r."name" = a."repo"
+        JOIN "SourceFile" f ON f."repository" = r."id" AND f."path" = a."filepath"''')
+    connection.execute('DROP TABLE "Annotation"')
+    connection.execute('ALTER TABLE "Annotation_new" RENAME TO "Annotation"')
+
+def migrate_add_annotation_counts(connection):
+    """Each source file keeps a count of its annotations."""
+    connection.execute('''
+        ALTER TABLE "SourceFile"
+        ADD COLUMN "annotation_count" INTEGER NOT NULL DEFAULT 0''')
+    connection.execute('''
+        UPDATE "SourceFile" SET "annotation_count" = (
+            SELECT COUNT(*) FROM "Annotation"
+            WHERE "Annotation"."source_file" = "SourceFile"."id"
+            )''')
+
+def migrate_add_rendered_annotation_content(connection):
+    """Annotations store their content rendered as html. Existing annotations
+    have no version, so they are rendered the first time they are read."""
+    connection.execute("""
+        ALTER TABLE "Annotation"
+        ADD COLUMN "content_html" TEXT NOT NULL DEFAULT ''""")
+    connection.execute('''
+        ALTER TABLE "Annotation"
+        ADD COLUMN "content_html_version" INTEGER''')
+
+def migrate_add_annotation_blob_sha(connection):
+    """Annotations record the SHA of the blob they were made against. We do
+    not know it for existing annotations, they are left blank and take on
+    whichever blob is current when their file is next viewed."""
+    connection.execute("""
+        ALTER TABLE "Annotation"
+        ADD COLUMN "blob_sha" TEXT NOT NULL DEFAULT ''""")
+
+
+# Each migration takes the database from one schema version to the next, the
+# version is stored in sqlite's 'user_version' pragma. Only append to this list.
+# Note that the migrations need not create indexes, Pony creates any missing
+# indexes when it generates the mapping.
+migrations = [
+    migrate_line_numbers_to_integers,
+    migrate_to_repository_and_source_file_entities,
+    migrate_add_annotation_counts,
+    migrate_add_rendered_annotation_content,
+    migrate_add_annotation_blob_sha,
+    ]
+
+def migrate_database(database_filename):
+    """Bring an existing database up to the current schema version, this must
+    be done before Pony generates the mapping. A database without any tables is
+    new, so Pony will create the tables and we simply mark it as up to date."""
+    connection = sqlite3.connect(database_filename, isolation_level=None)
+    try:
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        is_new = connection.execute(
+            '''SELECT COUNT(*) FROM sqlite_master
+               WHERE type = 'table' AND name = 'Annotation' ''').fetchone()[0] == 0
+        if is_new:
+            version = len(migrations)
+        connection.execute('BEGIN')
+        for migration in migrations[version:]:
+            migration(connection)
+        connection.execute('PRAGMA user_version = {}'.format(len(migrations)))
+        connection.execute('COMMIT')
+    except Exception:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+
+search_index_triggers = {
+    'annotation_search_insert': '''
+        CREATE TRIGGER "annotation_search_insert" AFTER INSERT ON "Annotation" BEGIN
+            INSERT INTO "AnnotationSearch" ("rowid", "content")
+            VALUES (new."id", new."content");
+        END''',
+    'annotation_search_delete': '''
+        CREATE TRIGGER "annotation_search_delete" AFTER DELETE ON "Annotation" BEGIN
+            INSERT INTO "AnnotationSearch" ("AnnotationSearch", "rowid", "content")
+            VALUES ('delete', old."id", old."content");
+        END''',
+    'annotation_search_update': '''
+        CREATE TRIGGER "annotation_search_update" AFTER UPDATE OF "content" ON "Annotation" BEGIN
+            INSERT INTO "AnnotationSearch" ("AnnotationSearch", "rowid", "content")
+            VALUES ('delete', old."id", old."content");
+            INSERT INTO "AnnotationSearch" ("rowid", "content")
+            VALUES (new."id", new."content");
+        END''',
+    }
+
+def ensure_search_index(database_filename):
+    """Annotation content is indexed by an FTS5 table which is kept in sync with
+    the Annotation table by triggers. Pony knows nothing about either, so this
+    is called after the mapping is generated. If any of the triggers are missing
+    (a new database, or the Annotation table has been rebuilt or dropped) then
+    we create them and rebuild the index from the Annotation table."""
+    connection = sqlite3.connect(database_filename, isolation_level=None)
+    try:
+        existing = {name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        if existing.issuperset(search_index_triggers):
+            return
+        connection.execute('BEGIN')
+        connection.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS "AnnotationSearch" USING fts5(
+                "content",
+                content='Annotation',
+                content_rowid='id',
+                tokenize='porter unicode61'
+                )''')
+        for name, create_trigger in search_index_triggers.items():
+            connection.execute('DROP TRIGGER IF EXISTS "{}"'.format(name))
+            connection.execute(create_trigger)
+        connection.execute('''
+            INSERT INTO "AnnotationSearch" ("AnnotationSearch") VALUES ('rebuild')''')
+        connection.execute('COMMIT')
+    except Exception:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+    finally:
+        connection.close()
+
+@appraisal.command()
+@click.option('--db-file', default='play.sqlite')
+def migrate(db_file):
+    """Upgrade an existing database to the current schema, this also happens
+    automatically whenever the database is opened."""
+    migrate_database(generated_file_path(db_file))
+
+
 database = orm.Database()
 def set_database(db_file='play.sqlite', reset=False):
     database_filename = generated_file_path(db_file)
     # Note that for testing this could maybe be :memory: but then again
     # sometimes it is nice to look at the database after testing has finished.
     # We may have to actually delete the file if reset is true.
+    os.makedirs(os.path.dirname(database_filename), exist_ok=True)
+    migrate_database(database_filename)
     database.bind('sqlite', database_filename, create_db=True)
     database.generate_mapping(create_tables=True)
     if reset:
         database.drop_all_tables(with_all_data=True)
         database.create_tables()
+    ensure_search_index(database_filename)
+
+class Repository(database.Entity):
+    owner = orm.Required(str)
+    name = orm.Required(str)
+    files = orm.Set('SourceFile')
+    orm.composite_key(owner, name)
+
+
+class SourceFile(database.Entity):
+    repository = orm.Required(Repository)
+    path = orm.Required(str)
+    annotations = orm.Set('Annotation')
+    # Maintained by whoever creates or deletes annotations, so that we can show
+    # which files are annotated without counting the annotations of each file.
+    annotation_count = orm.Required(int, default=0)
+    orm.composite_key(repository, path)
+    orm.composite_index(repository, annotation_count)
+
+    @classmethod
+    def lookup(cls, owner, repo, path):
+        """Returns the source file or None if we have never stored anything
+        for that file."""
+        repository = Repository.get(owner=owner, name=repo)
+        if repository is None:
+            return None
+        return cls.get(repository=repository, path=path)
+
+    @classmethod
+    def get_or_create(cls, owner, repo, path):
+        repository = Repository.get(owner=owner, name=repo)
+        if repository is None:
+            repository = Repository(owner=owner, name=repo)
+        source_file = cls.get(repository=repository, path=path)
+        if source_file is None:
+            source_file = cls(repository=repository, path=path)
+        return source_file
+
+
+class SafeUrlTreeprocessor(markdown.treeprocessors.Treeprocessor):
+    """Removes any link or image url which is not http(s), mailto or relative,
+    in particular 'javascript:' urls."""
+    safe_schemes = ['http', 'https', 'mailto', '']
+    url_attributes = {'a': 'href', 'img': 'src'}
+
+    def run(self, root):
+        for element in root.iter():
+            attribute = self.url_attributes.get(element.tag)
+            url = element.get(attribute) if attribute else None
+            if url is None:
+                continue
+            scheme = urllib.parse.urlparse(url.strip()).scheme.lower()
+            if scheme not in self.safe_schemes:
+                del element.attrib[attribute]
+
+
+class SafeMarkdownExtension(markdown.Extension):
+    """Annotation content is markdown written by users, so we do not allow raw
+    html (it is escaped instead) nor unsafe urls."""
+    def extendMarkdown(self, md, md_globals):
+        del md.preprocessors['html_block']
+        del md.inlinePatterns['html']
+        md.treeprocessors.add('safe_urls', SafeUrlTreeprocessor(md), '_end')
+
+
+# Bump this whenever 'render_markdown' changes, stored annotations are then
+# rendered again the next time they are read.
+annotation_html_version = 1
+
+def render_markdown(content):
+    renderer = markdown.Markdown(extensions=[
+        SafeMarkdownExtension(),
+        'markdown.extensions.fenced_code',
+        'markdown.extensions.codehilite',
+        ])
+    return renderer.convert(content)
+
 
 class Annotation(database.Entity):
-    repo = orm.Required(str)
-    repo_owner = orm.Required(str)
-    filepath = orm.Required(str)
-    line_number = orm.Required(str)
+    source_file = orm.Required(SourceFile)
+    line_number = orm.Required(int)
     content = orm.Required(str)
+    # The content is rendered (from markdown) when it is saved rather than in
+    # the browser each time it is viewed.
+    content_html = orm.Optional(str)
+    content_html_version = orm.Optional(int)
+    # The blob the line number refers to, when the file changes the annotation
+    # is moved to the corresponding line of the new blob, see
+    # 'reanchor_annotations'. Empty if not known.
+    blob_sha = orm.Optional(str)
+    orm.composite_index(source_file, line_number)
+
+    def render_content(self):
+        self.content_html = render_markdown(self.content)
+        self.content_html_version = annotation_html_version
+
+    def before_insert(self):
+        self.render_content()
+
+    def before_update(self):
+        self.render_content()
+
+    def rendered_content(self):
+        """Returns the html of the content, rendering it again if it was stored
+        by an older version of 'render_markdown' (or not stored at all)."""
+        if self.content_html_version != annotation_html_version:
+            self.render_content()
+        return self.content_html
 
     def jsonify(self):
-        return { 'repo': self.repo,
-                 'repo_owner': self.repo_owner,
-                 'filepath': self.filepath,
+        source_file = self.source_file
+        return { 'repo': source_file.repository.name,
+                 'repo_owner': source_file.repository.owner,
+                 'filepath': source_file.path,
                  'line_number': self.line_number,
-                 'content': self.content }
+                 'content': self.content,
+                 'content_html': self.rendered_content() }
 
 
 def has_extension(filename, extension):
@@ -92,8 +730,10 @@ def reset_database():
 import flask
 import flask_jsglue
 import flask_wtf
-from wtforms import StringField
+from wtforms import StringField, IntegerField
 from wtforms.validators import InputRequired
+from werkzeug.datastructures import MultiDict
+import werkzeug.exceptions
 
 application = flask.Flask(__name__)
 application.config['TEST_SERVER_PORT'] = 9001
@@ -120,20 +760,921 @@ def success_response(results=None):
     results['success'] = True
     return flask.jsonify(results)
 
+class SingleFlight(object):
+    """Makes sure that only one call for a given key runs at a time. Anyone
+    asking for the same key while a call is running waits for that call and
+    shares its result (or its exception) instead of making the call again."""
+    class Call(object):
+        __slots__ = ['done', 'result', 'error']
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class LRUCache(object):
+    """A small thread-safe, in-process, least-recently-used cache. The size of
+    each value is measured with `sizeof` and the least recently used entries
+    are evicted whenever the total size exceeds `max_size`."""
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                # Never going to fit, and we do not want to evict everything
+                # else trying.
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _key, (_value, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class HighlightTimeout(Exception):
+    pass
+
+
+class HighlightedLines(object):
+    """The lexed tokens of a source file, kept compactly so that any range of
+    lines can be rendered to html without lexing the file again. Rather than a
+    tuple per token we keep the whole text once, plus arrays holding for each
+    token the id of its token type and the offset at which it ends. Tokens are
+    split at newlines so that each line is a contiguous run of tokens,
+    `line_ends` holds the index of the token after the last one of each line."""
+    __slots__ = ('text', 'token_types', 'token_ends', 'line_ends', 'type_names')
+
+    def __init__(self, text, token_types, token_ends, line_ends, type_names):
+        self.text = text
+        self.token_types = token_types
+        self.token_ends = token_ends
+        self.line_ends = line_ends
+        # Token types are shared by all of the tokens and so are only stored
+        # once, token_types indexes into this list.
+        self.type_names = type_names
+
+    @classmethod
+    def from_tokens(cls, tokensource, deadline=None):
+        """Raises `HighlightTimeout` if still going at `deadline`, as given by
+        `time.monotonic`."""
+        type_ids = {}
+        text = []
+        offset = 0
+        token_types = array.array('H')
+        token_ends = array.array('I')
+        line_ends = array.array('I')
+        for token_type, value in tokensource:
+            type_id = type_ids.setdefault(token_type, len(type_ids))
+            for part in value.splitlines(True):
+                text.append(part)
+                offset += len(part)
+                token_types.append(type_id)
+                token_ends.append(offset)
+                if part.endswith('\n'):
+                    line_ends.append(len(token_ends))
+            if deadline is not None and len(token_ends) % 1024 == 0 and \
+               time.monotonic() > deadline:
+                raise HighlightTimeout()
+        if not line_ends or line_ends[-1] != len(token_ends):
+            # The last line did not end with a newline.
+            line_ends.append(len(token_ends))
+        type_names = [str(token_type) for token_type in type_ids]
+        return cls(''.join(text), token_types, token_ends, line_ends, type_names)
+
+    @classmethod
+    def plain(cls, text):
+        """Plain text, one token per line, as pygments' `TextLexer` would give
+        (including its normalising of newlines and stripping of leading and
+        trailing blank lines), but without the cost of lexing."""
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        text = text.strip('\n') + '\n'
+        # Found with 'find' rather than by splitting the text, as that would
+        # hold every line at once.
+        token_ends = array.array('I')
+        end = text.find('\n')
+        while end != -1:
+            token_ends.append(end + 1)
+            end = text.find('\n', end + 1)
+        token_types = array.array('H', [0]) * len(token_ends)
+        line_ends = array.array('I', range(1, len(token_ends) + 1))
+        return cls(text, token_types, token_ends, line_ends, ['Token.Text'])
+
+    def __len__(self):
+        return len(self.line_ends)
+
+    def nbytes(self):
+        """Roughly the memory held, for the purpose of bounding caches."""
+        return (len(self.text) +
+                sum(len(a) * a.itemsize for a in
+                    (self.token_types, self.token_ends, self.line_ends)))
+
+    def tokens(self, start, stop):
+        """The (token type, text) pairs of the lines in [start, stop)."""
+        token_types = [string_to_tokentype(name) for name in self.type_names]
+        first = self.line_ends[start - 1] if start > 0 else 0
+        last = self.line_ends[stop - 1] if stop > start else first
+        offset = self.token_ends[first - 1] if first > 0 else 0
+        for index in range(first, last):
+            end = self.token_ends[index]
+            yield token_types[self.token_types[index]], self.text[offset:end]
+            offset = end
+
+    def html_lines(self, start, stop, formatter):
+        """The highlighted html of each of the lines in [start, stop)."""
+        return formatter.highlight_lines(self.tokens(start, stop))
+
+    def to_json(self):
+        return {'text': self.text,
+                'token_types': self.token_types.tolist(),
+                'token_ends': self.token_ends.tolist(),
+                'line_ends': self.line_ends.tolist(),
+                'type_names': self.type_names}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['text'],
+                   array.array('H', data['token_types']),
+                   array.array('I', data['token_ends']),
+                   array.array('I', data['line_ends']),
+                   data['type_names'])
+
+
+class HighlightCache(object):
+    """Caches highlighted source code so that viewing the same blob twice does
+    not run pygments twice. What we cache is the lexed `HighlightedLines`, from
+    which any range of lines can be rendered, merged with annotations, without
+    lexing again. Entries are keyed by the content (the blob SHA if
+    we have one, otherwise a hash of the source itself) together with the lexer.
+    There are two tiers, an in-process LRU and a
+    directory of files (under `generated/`) which survives restarts. Both are
+    bounded in size, the disk tier evicts the least recently read files."""
+    # Bump this whenever the format of the cached output changes.
+    format_version = 3
+
+    def __init__(self, directory, memory_size, disk_size):
+        self.directory = directory
+        self.disk_size = disk_size
+        self.memory = LRUCache(memory_size, sizeof=HighlightedLines.nbytes)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.flights = SingleFlight()
+        self._disk_lock = threading.Lock()
+        self._disk_usage = None
+
+    def stats(self):
+        return {'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'timeouts': self.timeouts,
+                'shared': self.flights.shared,
+                'memory_size': self.memory.size,
+                'disk_size': self._disk_usage or 0}
+
+    def key(self, content_id, lexer_class):
+        key_source = repr((self.format_version, content_id, lexer_class.__name__))
+        return hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as cache_file:
+                result = HighlightedLines.from_json(json.load(cache_file))
+        except FileNotFoundError:
+            return None
+        # Touch the file so that eviction is least-recently-*used*.
+        os.utime(path, None)
+        return result
+
+    def _write_disk(self, key, highlighted):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._disk_path(key)
+        # Write to a temporary file and rename so that a concurrent reader
+        # never sees a half written file.
+        temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(temp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump(highlighted.to_json(), cache_file)
+        os.replace(temp_path, path)
+        with self._disk_lock:
+            if self._disk_usage is None:
+                self._disk_usage = self._scan_disk_usage()
+            else:
+                self._disk_usage += os.path.getsize(path)
+            if self._disk_usage > self.disk_size:
+                self._evict_disk()
+
+    def _cache_files(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.json'):
+                yield entry
+
+    def _scan_disk_usage(self):
+        return sum(entry.stat().st_size for entry in self._cache_files())
+
+    def _evict_disk(self):
+        # We evict down to 90% of the limit so that we do not end up scanning
+        # the directory on every subsequent write.
+        target = self.disk_size * 0.9
+        entries = sorted(self._cache_files(), key=lambda e: e.stat().st_mtime)
+        usage = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if usage <= target:
+                break
+            try:
+                usage -= entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        self._disk_usage = usage
+
+    def highlight(self, source_code, lexer_class, content_id=None, time_budget=None):
+        """Return the `HighlightedLines` for the given source code, only running
+        pygments if we have not seen this content before. See `lex_source` for
+        the `time_budget`, if it runs out we return the plain text but only
+        keep that in memory, so that once it is evicted (or on another worker,
+        or after a restart) we try lexing it again."""
+        if content_id is None:
+            source_bytes = source_code
+            if isinstance(source_bytes, str):
+                source_bytes = source_bytes.encode('utf-8')
+            content_id = hashlib.sha1(source_bytes).hexdigest()
+        key = self.key(content_id, lexer_class)
+
+        highlighted = self.memory.get(key)
+        if highlighted is not None:
+            self.memory_hits += 1
+            return highlighted
+        if lexer_class is TextLexer:
+            # Cheaper to split it again than to read it back from disk, so
+            # plain text is only kept in memory.
+            highlighted = lex_source(source_code, lexer_class)
+            self.memory.put(key, highlighted)
+            return highlighted
+        # Several requests for the same new file should only lex it once.
+        return self.flights.do(
+            key, lambda: self._highlight_miss(key, source_code, lexer_class, time_budget))
+
+    def _highlight_miss(self, key, source_code, lexer_class, time_budget):
+        highlighted = self._read_disk(key)
+        if highlighted is not None:
+            self.disk_hits += 1
+            self.memory.put(key, highlighted)
+            return highlighted
+
+        self.misses += 1
+        try:
+            highlighted = lex_source(source_code, lexer_class,
+                                     time_budget=time_budget, fallback=False)
+        except HighlightTimeout:
+            self.timeouts += 1
+            highlighted = lex_source(source_code, TextLexer)
+            self.memory.put(key, highlighted)
+            return highlighted
+        self.memory.put(key, highlighted)
+        self._write_disk(key, highlighted)
+        return highlighted
+
+
+application.config['HIGHLIGHT_CACHE_MEMORY_SIZE'] = 64 * 1024 * 1024
+application.config['HIGHLIGHT_CACHE_DISK_SIZE'] = 512 * 1024 * 1024
+highlight_cache = HighlightCache(
+    generated_file_path('highlight-cache/'),
+    memory_size=application.config['HIGHLIGHT_CACHE_MEMORY_SIZE'],
+    disk_size=application.config['HIGHLIGHT_CACHE_DISK_SIZE']
+    )
+
+
+class CachedResponse(object):
+    def __init__(self, body, etag=None, last_modified=None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.time()
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+class GitHubClient(object):
+    """All of our traffic to the github api goes through here. We use a single
+    pooled session so that connections are reused, and we keep the responses
+    along with their ETag/Last-Modified headers. A response younger than `ttl`
+    seconds is served without contacting github at all, an older one is
+    revalidated with a conditional request, and if github says 304 (not
+    modified) we serve the stored body (304s do not count against the rate
+    limit). The store is bounded by the total size of the stored bodies.
+    Concurrent requests for the same thing are coalesced into one request to
+    github, and at most `max_concurrency` requests are made at once, the rest
+    wait their turn."""
+    api_url = 'https://api.github.com'
+
+    def __init__(self, cache_size, ttl, pool_size=10, max_concurrency=8):
+        self.ttl = ttl
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size
+            )
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+        self.cache = LRUCache(cache_size, sizeof=lambda response: len(response.body))
+        self.fresh_hits = 0
+        self.not_modified = 0
+        self.downloads = 0
+        # As last reported by github, None until we have made a request.
+        self.rate_limit_remaining = None
+        self.flights = SingleFlight()
+        self._upstream = threading.BoundedSemaphore(max_concurrency)
+
+    def stats(self):
+        return {'fresh_hits': self.fresh_hits,
+                'not_modified': self.not_modified,
+                'downloads': self.downloads,
+                'coalesced': self.flights.shared,
+                'cache_size': self.cache.size,
+                'rate_limit_remaining': self.rate_limit_remaining}
+
+    def url(self, path):
+        return '{}/{}'.format(self.api_url, path.lstrip('/'))
+
+    def get(self, path, params=None, ttl=None, cache=True, accept=None):
+        """Get the given api path, returning a `CachedResponse`. Raises a
+        `requests.HTTPError` if github does not respond successfully. If
+        `cache` is False the response is neither looked up in nor added to the
+        store, which is useful for immutable objects that the caller keeps in
+        a store of its own. `accept` overrides the default media type."""
+        ttl = self.ttl if ttl is None else ttl
+        url = self.url(path)
+        key = (url, tuple(sorted((params or {}).items())), accept)
+        cached = self.cache.get(key) if cache else None
+        if cached is not None and time.time() - cached.fetched_at < ttl:
+            self.fresh_hits += 1
+            return cached
+        return self.flights.do(
+            key, lambda: self._fetch(url, params, key, cached, cache, accept))
+
+    def _fetch(self, url, params, key, cached, cache, accept):
+        headers = {}
+        if accept is not None:
+            headers['Accept'] = accept
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        with self._upstream:
+            response = self.session.get(url, params=params, headers=headers)
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            self.rate_limit_remaining = int(remaining)
+        if cached is not None and response.status_code == 304:
+            self.not_modified += 1
+            cached.fetched_at = time.time()
+            return cached
+        response.raise_for_status()
+        self.downloads += 1
+        fetched = CachedResponse(
+            response.content,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified')
+            )
+        if cache:
+            self.cache.put(key, fetched)
+        return fetched
+
+    def get_json(self, path, params=None, ttl=None, cache=True):
+        return self.get(path, params=params, ttl=ttl, cache=cache).json()
+
+
+application.config['GITHUB_CACHE_SIZE'] = 128 * 1024 * 1024
+application.config['GITHUB_CACHE_TTL'] = 60
+application.config['GITHUB_MAX_CONCURRENCY'] = 8
+github = GitHubClient(
+    cache_size=application.config['GITHUB_CACHE_SIZE'],
+    ttl=application.config['GITHUB_CACHE_TTL'],
+    max_concurrency=application.config['GITHUB_MAX_CONCURRENCY']
+    )
+
+
+class TreeNode(object):
+    """A node in the path trie of a repository tree, `entry` is the github
+    tree entry for the path (None for the root)."""
+    __slots__ = ['name', 'path', 'entry', 'children', '_sorted_children']
+
+    def __init__(self, name, path, entry=None):
+        self.name = name
+        self.path = path
+        self.entry = entry
+        self.children = {}
+        self._sorted_children = None
+
+    @property
+    def type(self):
+        return self.entry['type'] if self.entry else 'tree'
+
+    @property
+    def size(self):
+        return self.entry.get('size') if self.entry else None
+
+    def sorted_children(self):
+        """Directories first, then files, each alphabetically."""
+        if self._sorted_children is None:
+            self._sorted_children = sorted(
+                self.children.values(),
+                key=lambda node: (node.type != 'tree', node.name)
+                )
+        return self._sorted_children
+
+    def jsonify(self):
+        return {'name': self.name,
+                'path': self.path,
+                'type': self.type,
+                'size': self.size}
+
+
+class RepositoryTree(object):
+    """The recursive listing of a git tree as returned by github. For large
+    trees we view one directory at a time, so the entries are indexed (once,
+    on first use) into a trie of `TreeNode`s."""
+    def __init__(self, sha, tree_json, size):
+        self.sha = sha
+        self.entries = tree_json['tree']
+        self.truncated = tree_json.get('truncated', False)
+        # The size of the json we parsed, used to bound the tree store.
+        self.size = size
+        self._root = None
+        self._index_lock = threading.Lock()
+
+    @property
+    def root(self):
+        with self._index_lock:
+            if self._root is None:
+                self._root = self._build_index()
+        return self._root
+
+    def _build_index(self):
+        root = TreeNode('', '')
+        for entry in self.entries:
+            node = root
+            *directories, name = entry['path'].split('/')
+            for directory in directories:
+                child = node.children.get(directory)
+                if child is None:
+                    path = directory if not node.path else node.path + '/' + directory
+                    child = TreeNode(directory, path)
+                    node.children[directory] = child
+                node = child
+            existing = node.children.get(name)
+            if existing is None:
+                node.children[name] = TreeNode(name, entry['path'], entry)
+            else:
+                # We may have created the directory node before seeing its
+                # own entry (github lists them in order, but let's not rely
+                # on that).
+                existing.entry = entry
+        return root
+
+    def node(self, path):
+        """Returns the `TreeNode` for the given path, or None if there is no
+        such path in the tree."""
+        node = self.root
+        for name in filter(None, path.split('/')):
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+
+class TreeStore(object):
+    """Git trees are immutable once you know their SHA, so we keep the parsed
+    trees keyed by SHA and never revalidate them. The only thing that can
+    change is which commit a branch points at, that lookup goes through the
+    github client with a short TTL."""
+    def __init__(self, client, size, branch_ttl):
+        self.client = client
+        self.branch_ttl = branch_ttl
+        self.trees = LRUCache(size, sizeof=lambda tree: tree.size)
+
+    def resolve_branch(self, owner, repo, branch='master'):
+        ref_path = 'repos/{}/{}/git/refs/heads/{}'.format(owner, repo, branch)
+        ref = self.client.get_json(ref_path, ttl=self.branch_ttl)
+        return ref['object']['sha']
+
+    def tree(self, owner, repo, sha):
+        tree = self.trees.get(sha)
+        if tree is None:
+            tree_path = 'repos/{}/{}/git/trees/{}'.format(owner, repo, sha)
+            response = self.client.get(tree_path, params={'recursive': 1}, cache=False)
+            tree = RepositoryTree(sha, response.json(), len(response.body))
+            self.trees.put(sha, tree)
+        return tree
+
+    def branch_tree(self, owner, repo, branch='master'):
+        return self.tree(owner, repo, self.resolve_branch(owner, repo, branch))
+
+
+application.config['TREE_STORE_SIZE'] = 256 * 1024 * 1024
+application.config['BRANCH_TTL'] = 10
+tree_store = TreeStore(
+    github,
+    size=application.config['TREE_STORE_SIZE'],
+    branch_ttl=application.config['BRANCH_TTL']
+    )
+
+
+class BlobStore(object):
+    """The contents of blobs keyed by SHA. Like trees, blobs are immutable so
+    once fetched they never need revalidating. We ask github for the raw media
+    type so that we get the bytes themselves rather than base64 in json."""
+    raw_media_type = 'application/vnd.github.v3.raw'
+
+    def __init__(self, client, size):
+        self.client = client
+        self.blobs = LRUCache(size)
+
+    def blob(self, owner, repo, sha):
+        contents = self.blobs.get(sha)
+        if contents is None:
+            blob_path = 'repos/{}/{}/git/blobs/{}'.format(owner, repo, sha)
+            response = self.client.get(blob_path, cache=False, accept=self.raw_media_type)
+            contents = response.body
+            self.blobs.put(sha, contents)
+        return contents
+
+
+application.config['BLOB_STORE_SIZE'] = 256 * 1024 * 1024
+blob_store = BlobStore(github, size=application.config['BLOB_STORE_SIZE'])
+
+
+class RepositoryBackend(object):
+    """Where the trees and blobs of repositories are read from. Trees are
+    returned as `RepositoryTree`s and blobs as bytes, keyed by their SHA."""
+    def branch_tree(self, owner, repo, branch='master'):
+        raise NotImplementedError
+
+    def blob(self, owner, repo, sha):
+        raise NotImplementedError
+
+    def blob_sha(self, owner, repo, filepath, tree=None):
+        """The SHA of the blob at the given path on the default branch, found
+        in the tree. Aborts with a 404 if there is no such file."""
+        if tree is None:
+            tree = self.branch_tree(owner, repo)
+        node = tree.node(filepath)
+        if node is not None and node.type == 'blob':
+            return node.entry['sha']
+        return self.missing_blob_sha(owner, repo, filepath, tree)
+
+    def missing_blob_sha(self, owner, repo, filepath, tree):
+        flask.abort(404)
+
+
+class GitHubBackend(RepositoryBackend):
+    """Reads everything through the github api."""
+    def __init__(self, client, trees, blobs):
+        self.client = client
+        self.trees = trees
+        self.blobs = blobs
+
+    def branch_tree(self, owner, repo, branch='master'):
+        return self.trees.branch_tree(owner, repo, branch)
+
+    def blob(self, owner, repo, sha):
+        return self.blobs.blob(owner, repo, sha)
+
+    def missing_blob_sha(self, owner, repo, filepath, tree):
+        if not tree.truncated:
+            flask.abort(404)
+        # A truncated tree does not list every file, so ask github after all.
+        repository_path = 'repos/{0}/{1}'.format(owner, repo)
+        try:
+            gh_json = self.client.get_json('{0}/contents/{1}'.format(repository_path, filepath))
+        except requests.HTTPError as error:
+            if error.response is not None and error.response.status_code == 404:
+                flask.abort(404)
+            raise
+        if not isinstance(gh_json, dict) or gh_json.get('type') != 'file':
+            flask.abort(404)
+        return gh_json['sha']
+
+
+class LocalMirrorBackend(RepositoryBackend):
+    """Keeps a bare mirror clone of each repository under `directory` and reads
+    trees and blobs straight out of its object database, so viewing a file
+    costs no network round trip at all. A mirror is updated with an incremental
+    fetch when it is used, at most once every `fetch_interval` seconds. If that
+    fetch fails we carry on serving what we already have. Mirrors are cloned
+    into a temporary directory and only then moved into place, as several
+    processes may share the directory and a clone may be killed partway."""
+    def __init__(self, directory, remote_url, fetch_interval, size):
+        self.directory = directory
+        # Formatted with the owner and repo, eg. 'https://github.com/{owner}/{repo}.git'
+        self.remote_url = remote_url
+        self.fetch_interval = fetch_interval
+        self.trees = LRUCache(size, sizeof=lambda tree: tree.size)
+        self._fetched_at = {}
+        self._locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def mirror_path(self, owner, repo):
+        return os.path.join(self.directory, owner, repo + '.git')
+
+    def git(self, mirror_path, *args):
+        command = ['git', '--git-dir', mirror_path] + list(args)
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return result.stdout
+
+    def update(self, owner, repo):
+        """Clone the mirror if we do not have it yet, otherwise fetch into it
+        if it has not been fetched recently. Returns the path of the mirror."""
+        mirror_path = self.mirror_path(owner, repo)
+        with self._lock:
+            lock = self._locks[mirror_path]
+        with lock:
+            fetched_at = self._fetched_at.get(mirror_path)
+            if fetched_at is not None and time.time() - fetched_at < self.fetch_interval:
+                return mirror_path
+            if not self.is_mirror(mirror_path):
+                self.clone(owner, repo, mirror_path)
+            else:
+                try:
+                    self.git(mirror_path, 'fetch', '--prune', '--quiet')
+                except subprocess.CalledProcessError as error:
+                    application.logger.warning('Could not update mirror {}: {}'.format(
+                        mirror_path, error.stderr.decode('utf-8', 'replace')))
+            self._fetched_at[mirror_path] = time.time()
+        return mirror_path
+
+    def is_mirror(self, mirror_path):
+        """Whether there is a usable mirror at the path, a mirror which has no
+        HEAD was left by some earlier failure and is treated as missing."""
+        if not os.path.isdir(mirror_path):
+            return False
+        try:
+            self.git(mirror_path, 'rev-parse', '--verify', '--quiet', 'HEAD')
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def clone(self, owner, repo, mirror_path):
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(mirror_path, uuid.uuid4().hex)
+        url = self.remote_url.format(owner=owner, repo=repo)
+        command = ['git', 'clone', '--mirror', '--quiet', url, temp_path]
+        try:
+            subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        except subprocess.CalledProcessError:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            flask.abort(404)
+        if os.path.isdir(mirror_path) and not self.is_mirror(mirror_path):
+            # Move a broken mirror aside first, a directory can only be
+            # replaced by renaming if it is empty.
+            broken_path = '{}.{}.broken'.format(mirror_path, uuid.uuid4().hex)
+            try:
+                os.rename(mirror_path, broken_path)
+            except FileNotFoundError:
+                pass
+            else:
+                shutil.rmtree(broken_path, ignore_errors=True)
+        try:
+            os.replace(temp_path, mirror_path)
+        except OSError:
+            # Another process got there first, its mirror is as good as ours.
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def branch_tree(self, owner, repo, branch='master'):
+        mirror_path = self.update(owner, repo)
+        try:
+            commit = self.git(mirror_path, 'rev-parse', '--verify', '--quiet',
+                              'refs/heads/{}^{{commit}}'.format(branch))
+        except subprocess.CalledProcessError:
+            flask.abort(404)
+        sha = commit.decode('ascii').strip()
+        tree = self.trees.get(sha)
+        if tree is None:
+            listing = self.git(mirror_path, 'ls-tree', '-r', '-t', '-l', '-z', sha)
+            tree_json = {'tree': list(self._tree_entries(listing)), 'truncated': False}
+            tree = RepositoryTree(sha, tree_json, len(listing))
+            self.trees.put(sha, tree)
+        return tree
+
+    def _tree_entries(self, listing):
+        """Parses 'git ls-tree -l -z' output into entries like github's."""
+        for record in listing.split(b'\0'):
+            if not record:
+                continue
+            info, path = record.split(b'\t', 1)
+            mode, object_type, sha, size = info.decode('ascii').split()
+            entry = {'path': path.decode('utf-8'), 'mode': mode,
+                     'type': object_type, 'sha': sha}
+            if size != '-':
+                entry['size'] = int(size)
+            yield entry
+
+    def blob(self, owner, repo, sha):
+        try:
+            return self.git(self.mirror_path(owner, repo), 'cat-file', 'blob', sha)
+        except subprocess.CalledProcessError:
+            # Perhaps an old blob which has since been garbage collected.
+            flask.abort(404)
+
+
+application.config['REPOSITORY_BACKEND'] = 'github'
+application.config['MIRROR_DIRECTORY'] = generated_file_path('mirrors/')
+application.config['MIRROR_REMOTE_URL'] = 'https://github.com/{owner}/{repo}.git'
+application.config['MIRROR_FETCH_INTERVAL'] = 60
+repository_backends = {
+    'github': GitHubBackend(github, tree_store, blob_store),
+    'mirror': LocalMirrorBackend(
+        application.config['MIRROR_DIRECTORY'],
+        remote_url=application.config['MIRROR_REMOTE_URL'],
+        fetch_interval=application.config['MIRROR_FETCH_INTERVAL'],
+        size=application.config['TREE_STORE_SIZE']
+        )
+    }
+
+def repository_backend():
+    return repository_backends[application.config['REPOSITORY_BACKEND']]
+
+
+def render_annotation(annotation):
+    """Renders the html for a single annotation (as jsonified), the same markup
+    that 'annotate.js' creates for a new annotation."""
+    template = application.jinja_env.get_template('annotation.jinja')
+    return template.render(annotation=annotation)
+
+
+application.config['HIGHLIGHT_MAX_SIZE'] = 1024 * 1024
+application.config['HIGHLIGHT_MAX_LINE_LENGTH'] = 5000
+application.config['HIGHLIGHT_TIME_BUDGET'] = 2.0
+application.config['SOURCE_CHUNK_LINES'] = 500
+
+def has_long_line(source_code, max_length):
+    """Whether any line is longer than `max_length`, found by scanning from
+    one newline to the next rather than splitting the source into lines."""
+    newline = b'\n' if isinstance(source_code, bytes) else '\n'
+    start = 0
+    while True:
+        end = source_code.find(newline, start)
+        if end == -1:
+            return len(source_code) - start > max_length
+        if end - start > max_length:
+            return True
+        start = end + 1
+
+def source_lexer_class(filepath, source_code):
+    """Files larger than HIGHLIGHT_MAX_SIZE, or with any line longer than
+    HIGHLIGHT_MAX_LINE_LENGTH, are shown as plain text. Lexing those costs a
+    lot of time and memory for little benefit (they are usually generated)."""
+    if len(source_code) > application.config['HIGHLIGHT_MAX_SIZE']:
+        return TextLexer
+    if has_long_line(source_code, application.config['HIGHLIGHT_MAX_LINE_LENGTH']):
+        return TextLexer
+    return lexer_registry.lexer_class(filepath, source_code)
+
 class SourceCode(object):
-    def __init__(self, repo_owner, repo, filepath, source_code=None):
+    formatter_options = {'full': False, 'linenos': False}
+    # Shared, as creating a formatter means building its style tables.
+    formatter = CodeHtmlFormatter(**formatter_options)
+
+    def __init__(self, repo_owner, repo, filepath, source_code=None, blob_sha=None,
+                 annotations=None):
+        """If given, annotations should be a list of jsonified annotations for
+        this file, they are rendered inline with the source code."""
         self.repo_owner = repo_owner
         self.repo = repo
         self.filepath = filepath
+        self.blob_sha = blob_sha
         if source_code is None:
             with open(filepath, 'r') as source_file:
                 source_code = source_file.read()
-        lexer = PythonLexer()
-        formatter = CodeHtmlFormatter(
-            full=False,
-            linenos=False,
+        self.highlighted_lines = highlight_cache.highlight(
+            source_code, source_lexer_class(filepath, source_code),
+            content_id=blob_sha,
+            time_budget=application.config['HIGHLIGHT_TIME_BUDGET']
             )
-        self.highlighted_source = pygments.highlight(source_code, lexer, formatter)
+        self.annotations = annotations or []
+        # For very large files we only render a window of lines, the page then
+        # fetches the rest as they are needed.
+        self.window = None
+
+    @property
+    def num_lines(self):
+        return len(self.highlighted_lines)
+
+    def clamp_range(self, start, stop):
+        start = min(max(0, start), self.num_lines)
+        return start, min(max(start, stop), self.num_lines)
+
+    def set_window(self, start, stop):
+        self.window = self.clamp_range(start, stop)
+
+    def rendered_chunks(self, start, stop):
+        """Generates the html of the lines in [start, stop), annotations
+        included, SOURCE_CHUNK_LINES lines at a time, so that a large file
+        can be streamed out without ever building the whole page."""
+        annotation_html = collections.defaultdict(str)
+        for annotation in self.annotations:
+            if start <= annotation['line_number'] < stop:
+                annotation_html[annotation['line_number']] += render_annotation(annotation)
+        chunk_lines = application.config['SOURCE_CHUNK_LINES']
+        for chunk_start in range(start, stop, chunk_lines):
+            chunk_stop = min(stop, chunk_start + chunk_lines)
+            lines = self.highlighted_lines.html_lines(chunk_start, chunk_stop, self.formatter)
+            yield self.formatter.wrap_lines(lines, first_line_number=chunk_start,
+                                            annotation_html=annotation_html)
+
+    def render_lines(self, start, stop):
+        return ''.join(self.rendered_chunks(start, stop))
+
+    def highlighted_chunks(self):
+        start, stop = self.window or (0, self.num_lines)
+        return self.rendered_chunks(start, stop)
+
+    @property
+    def highlighted_source(self):
+        return ''.join(self.highlighted_chunks())
+
+    def snippet(self, line_number, context):
+        """(line number, html) of the given line and the `context` lines either
+        side of it, without any wrapping or annotations."""
+        start, stop = self.clamp_range(line_number - context, line_number + context + 1)
+        lines = self.highlighted_lines.html_lines(start, stop, self.formatter)
+        return [(number, markupsafe.Markup(line))
+                for number, line in enumerate(lines, start)]
 
 @application.route("/", methods=['GET'])
 def homepage():
@@ -146,17 +1687,106 @@ class Repo(object):
         self.owner = owner
         self.name = name
 
+class AnnotationCounts(object):
+    """The number of annotations on each annotated file of a repository, along
+    with the totals for each directory containing annotated files."""
+    def __init__(self, file_counts):
+        self.files = file_counts
+        self.directories = collections.Counter()
+        for path, count in file_counts.items():
+            directories = path.split('/')[:-1]
+            for index in range(1, len(directories) + 1):
+                self.directories['/'.join(directories[:index])] += count
+
+    @classmethod
+    def for_repository(cls, owner, repo_name):
+        """A single read of the counts kept on each source file."""
+        with orm.db_session:
+            query = orm.select(
+                (f.path, f.annotation_count) for f in SourceFile
+                if f.repository.owner == owner and
+                   f.repository.name == repo_name and
+                   f.annotation_count > 0
+                )
+            return cls(dict(query))
+
+    def count(self, path):
+        return self.files.get(path) or self.directories.get(path, 0)
+
+    def most_annotated(self):
+        """(path, count) for each annotated file, most annotated first."""
+        return sorted(self.files.items(), key=lambda item: (-item[1], item[0]))
+
+
+class DirectoryPage(object):
+    """One page of the children of a directory in a repository tree."""
+    def __init__(self, node, page, page_size):
+        children = node.sorted_children()
+        self.directory = node
+        self.num_pages = max(1, (len(children) + page_size - 1) // page_size)
+        self.page = min(max(1, page), self.num_pages)
+        start = (self.page - 1) * page_size
+        self.entries = children[start:start + page_size]
+
+    @property
+    def parents(self):
+        """The (name, path) of each directory above this one, for breadcrumbs."""
+        names = self.directory.path.split('/') if self.directory.path else []
+        return [(name, '/'.join(names[:index + 1])) for index, name in enumerate(names)]
+
+    def jsonify(self, annotation_counts):
+        entries = []
+        for node in self.entries:
+            entry = node.jsonify()
+            entry['annotation_count'] = annotation_counts.count(node.path)
+            entries.append(entry)
+        return {'path': self.directory.path,
+                'page': self.page,
+                'num_pages': self.num_pages,
+                'entries': entries}
+
+
+application.config['REPO_TREE_FLAT_LIMIT'] = 2000
+application.config['REPO_DIRECTORY_PAGE_SIZE'] = 200
+
+def directory_page(tree, path, page):
+    node = tree.node(path)
+    if node is None or node.type != 'tree':
+        flask.abort(404)
+    page_size = application.config['REPO_DIRECTORY_PAGE_SIZE']
+    return DirectoryPage(node, page, page_size)
+
 @application.route('/view-repo/<owner>/<repo_name>', methods=['GET'])
 def view_repo(owner, repo_name):
-    repository_url = 'https://api.github.com/repos/{}/{}'.format(owner, repo_name)
-    gh_resp = requests.get('{0}/git/trees/master'.format(repository_url))
-    master = gh_resp.json()
-    gh_resp = requests.get(
-        '{0}/git/trees/{1}'.format(repository_url, master['sha']),
-        params={'recursive': 1})
-    tree = gh_resp.json()
+    """Small repositories are listed in full, larger ones (or if a directory
+    is explicitly asked for) are shown one directory at a time."""
+    tree = repository_backend().branch_tree(owner, repo_name)
     repo = Repo(owner, repo_name)
-    return flask.render_template('view-repo.jinja', tree=tree, repo=repo)
+    annotation_counts = AnnotationCounts.for_repository(owner, repo_name)
+    if application.config['PREFETCH_ENABLED']:
+        prefetcher.prefetch_tree(owner, repo_name, tree, annotation_counts)
+    path = flask.request.args.get('path')
+    if path is None and len(tree.entries) <= application.config['REPO_TREE_FLAT_LIMIT']:
+        return flask.render_template(
+            'view-repo.jinja', tree=tree, repo=repo,
+            annotation_counts=annotation_counts
+            )
+    page = flask.request.args.get('page', 1, type=int)
+    directory = directory_page(tree, path or '', page)
+    return flask.render_template(
+        'view-repo.jinja', directory=directory, repo=repo,
+        annotation_counts=annotation_counts
+        )
+
+@application.route('/repo-directory/<owner>/<repo_name>', methods=['GET'])
+def repo_directory(owner, repo_name):
+    """Used to lazily expand a directory in the repository view."""
+    tree = repository_backend().branch_tree(owner, repo_name)
+    path = flask.request.args.get('path', '')
+    page = flask.request.args.get('page', 1, type=int)
+    directory = directory_page(tree, path, page)
+    annotation_counts = AnnotationCounts.for_repository(owner, repo_name)
+    return success_response(results={'directory': directory.jsonify(annotation_counts)})
 
 
 class RepoUrlForm(flask_wtf.FlaskForm):
@@ -184,28 +1814,423 @@ def view_repo_from_url():
     return flask.redirect(flask.url_for('view_repo', owner=repo_owner, repo_name=repo_name))
 
 
+application.config['REPORT_BATCH_SIZE'] = 500
+
+def repository_annotations(owner, repo_name, batch_size=None):
+    """Generates the (jsonified) annotations of a repository in order of file
+    path and line number. Rather than one query for everything we read a batch
+    at a time, each batch starting after the (path, line number) that the
+    previous batch ended on. Each batch is an index range scan so memory use is
+    bounded and the first annotations are available straight away."""
+    batch_size = batch_size or application.config['REPORT_BATCH_SIZE']
+    with orm.db_session:
+        repository = Repository.get(owner=owner, name=repo_name)
+        if repository is None:
+            return
+        repository_id = repository.id
+    last_path, last_line = '', -1
+    while True:
+        with orm.db_session:
+            query = orm.select(
+                a for a in Annotation
+                if a.source_file.repository.id == repository_id and
+                   (a.source_file.path > last_path or
+                    (a.source_file.path == last_path and a.line_number > last_line))
+                ).order_by(lambda a: (a.source_file.path, a.line_number))
+            batch = [a.jsonify() for a in query[:batch_size]]
+        for annotation in batch:
+            yield annotation
+        if len(batch) < batch_size:
+            return
+        last_path, last_line = batch[-1]['filepath'], batch[-1]['line_number']
+
+application.config['REPORT_FETCH_WORKERS'] = 8
+application.config['REPORT_SNIPPET_CONTEXT'] = 2
+
+class ReportFile(object):
+    """The annotations of one file in the report, along with its source code,
+    which is None if we could not fetch it."""
+    def __init__(self, path, annotations, source):
+        self.path = path
+        self.annotations = annotations
+        self.source = source
+
+    def snippet(self, annotation):
+        if self.source is None:
+            return []
+        context = application.config['REPORT_SNIPPET_CONTEXT']
+        return self.source.snippet(annotation['line_number'], context)
+
+def fetch_report_source(owner, repo_name, path, tree):
+    try:
+        return fetch_source(owner, repo_name, path, tree=tree)
+    except (requests.RequestException, werkzeug.exceptions.NotFound):
+        # Perhaps the file has since been removed, the report can still show
+        # the annotations.
+        return None
+
+def reanchor_repository_annotations(owner, repo_name, tree):
+    """Brings the annotations of every annotated file up to date with the
+    tree, see `reanchor_annotations`, which is otherwise only done when a
+    file is viewed."""
+    backend = repository_backend()
+    for path in AnnotationCounts.for_repository(owner, repo_name).files:
+        try:
+            blob_sha = backend.blob_sha(owner, repo_name, path, tree=tree)
+        except (requests.RequestException, werkzeug.exceptions.NotFound):
+            continue
+        reanchor_annotations(owner, repo_name, path, blob_sha)
+
+def report_files(owner, repo_name, workers=None):
+    """Generates a `ReportFile` for each annotated file of the repository, in
+    order of path. Each file is fetched (and highlighted) only once however
+    many annotations it has, and we fetch several files concurrently, keeping a
+    bounded number of fetches ahead of the file being rendered. Annotations
+    are first re-anchored, so that they match the snippets of the current
+    source."""
+    workers = workers or application.config['REPORT_FETCH_WORKERS']
+    try:
+        tree = repository_backend().branch_tree(owner, repo_name)
+    except (requests.RequestException, werkzeug.exceptions.NotFound):
+        tree = None
+    if tree is not None:
+        reanchor_repository_annotations(owner, repo_name, tree)
+    annotations = repository_annotations(owner, repo_name)
+    files = itertools.groupby(annotations, key=lambda a: a['filepath'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for path, path_annotations in files:
+            future = executor.submit(fetch_report_source, owner, repo_name, path, tree)
+            pending.append((path, list(path_annotations), future))
+            if len(pending) > workers:
+                path, path_annotations, future = pending.popleft()
+                yield ReportFile(path, path_annotations, future.result())
+        while pending:
+            path, path_annotations, future = pending.popleft()
+            yield ReportFile(path, path_annotations, future.result())
+
+def stream_template(template_name, **context):
+    """Like `flask.render_template` but returns a response that is streamed to
+    the client as the template is rendered. The context may contain generators
+    which are then only consumed as the page is sent."""
+    application.update_template_context(context)
+    template = application.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    # Without buffering each tiny piece of the template is a separate chunk.
+    stream.enable_buffering(50)
+    return flask.Response(flask.stream_with_context(stream))
+
 @application.route('/view-repo-report/<owner>/<repo_name>', methods=['GET'])
 def view_repo_report(owner, repo_name):
+    files = report_files(owner, repo_name)
+    annotation_counts = AnnotationCounts.for_repository(owner, repo_name)
+    repo = Repo(owner, repo_name)
+    return stream_template(
+        'repo-report.jinja', files=files, repo=repo,
+        annotation_counts=annotation_counts
+        )
+
+
+def file_annotations(owner, repo, filepath, start=None, stop=None):
+    """The jsonified annotations of the given file, in order of line number,
+    optionally only those with line numbers in the range [start, stop)."""
     with orm.db_session:
-        query = orm.select(
-            a for a in Annotation
-            if a.repo_owner == owner and
-               a.repo == repo_name
+        source_file = SourceFile.lookup(owner, repo, filepath)
+        if source_file is None:
+            return []
+        query = source_file.annotations.select()
+        if start is not None:
+            query = query.filter(lambda a: a.line_number >= start)
+        if stop is not None:
+            query = query.filter(lambda a: a.line_number < stop)
+        query = query.order_by(Annotation.line_number)
+        return [a.jsonify() for a in query]
+
+def displayed_lines(source):
+    """The lines of a blob as they are numbered when displayed, which is after
+    pygments has normalised the newlines and stripped any leading and trailing
+    blank lines (see `HighlightedLines.plain`)."""
+    return source.replace(b'\r\n', b'\n').replace(b'\r', b'\n').strip(b'\n').split(b'\n')
+
+def line_mapping(old_source, new_source):
+    """Maps each displayed line number of the old source to a displayed line
+    number of the new source. Unchanged lines map to wherever they now are,
+    changed lines to the corresponding line of whatever replaced them and
+    deleted lines to the line which now follows the deletion."""
+    old_lines = displayed_lines(old_source)
+    new_lines = displayed_lines(new_source)
+    last_line = max(0, len(new_lines) - 1)
+    mapping = array.array('I', range(len(old_lines)))
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for tag, old_start, old_stop, new_start, new_stop in matcher.get_opcodes():
+        for offset in range(old_stop - old_start):
+            if tag == 'equal':
+                new_line = new_start + offset
+            elif tag == 'replace':
+                new_line = new_start + min(offset, new_stop - new_start - 1)
+            else:
+                new_line = new_start
+            mapping[old_start + offset] = min(new_line, last_line)
+    return mapping
+
+class LineMappings(object):
+    """The `line_mapping`s between pairs of blobs, keyed by (old SHA, new SHA).
+    Blobs never change, so neither do the mappings, and each pair need only be
+    diffed once however many annotations, or viewers, it moves."""
+    def __init__(self, size):
+        self.mappings = LRUCache(size, sizeof=lambda mapping: mapping.itemsize * len(mapping))
+        self.flights = SingleFlight()
+        self.computed = 0
+
+    def stats(self):
+        return {'hits': self.mappings.hits,
+                'computed': self.computed,
+                'shared': self.flights.shared}
+
+    def mapping(self, backend, owner, repo, old_sha, new_sha):
+        key = (old_sha, new_sha)
+        mapping = self.mappings.get(key)
+        if mapping is None:
+            mapping = self.flights.do(
+                key, lambda: self._compute(backend, owner, repo, old_sha, new_sha))
+        return mapping
+
+    def _compute(self, backend, owner, repo, old_sha, new_sha):
+        mapping = line_mapping(backend.blob(owner, repo, old_sha),
+                               backend.blob(owner, repo, new_sha))
+        self.computed += 1
+        self.mappings.put((old_sha, new_sha), mapping)
+        return mapping
+
+application.config['LINE_MAPPING_CACHE_SIZE'] = 32 * 1024 * 1024
+line_mappings = LineMappings(size=application.config['LINE_MAPPING_CACHE_SIZE'])
+
+def map_line(mapping, line_number):
+    if mapping is None:
+        return line_number
+    if not mapping:
+        return 0
+    return mapping[min(line_number, len(mapping) - 1)]
+
+def reanchor_annotations(owner, repo, filepath, blob_sha):
+    """Moves any annotations of the file which were made against other blobs
+    to the corresponding lines of the blob `blob_sha`, and records that they
+    now refer to it, so each annotation is only moved once per change to the
+    file. Annotations that end up on the same line are merged into one. If an
+    old blob can no longer be fetched its annotations stay on the same line
+    numbers. Returns the number of annotations which were re-anchored."""
+    if not blob_sha:
+        return 0
+    with orm.db_session:
+        connection = database.get_connection()
+        rows = connection.execute(
+            '''SELECT a."id", a."line_number", a."content", a."blob_sha", f."id"
+               FROM "Annotation" a
+               JOIN "SourceFile" f ON a."source_file" = f."id"
+               JOIN "Repository" r ON f."repository" = r."id"
+               WHERE r."owner" = ? AND r."name" = ? AND f."path" = ?
+               ORDER BY a."line_number", a."id"''',
+            (owner, repo, filepath)).fetchall()
+        stale = [row for row in rows if row[3] != blob_sha]
+        if not stale:
+            return 0
+        source_file_id = stale[0][4]
+        # The id of the annotation now on each line of the current blob.
+        anchored = {row[1]: row[0] for row in rows if row[3] == blob_sha}
+        contents = {row[0]: row[2] for row in rows}
+        backend = repository_backend()
+        moves = []
+        merges = []
+        for old_sha, old_rows in itertools.groupby(sorted(stale, key=lambda row: row[3]),
+                                                   key=lambda row: row[3]):
+            mapping = None
+            if old_sha:
+                try:
+                    mapping = line_mappings.mapping(backend, owner, repo, old_sha, blob_sha)
+                except (requests.RequestException, werkzeug.exceptions.NotFound):
+                    pass
+            for annotation_id, line_number, _content, _sha, _file in old_rows:
+                new_line = map_line(mapping, line_number)
+                target_id = anchored.get(new_line)
+                if target_id is None:
+                    anchored[new_line] = annotation_id
+                    moves.append((new_line, blob_sha, annotation_id, old_sha))
+                else:
+                    merges.append((target_id, annotation_id, old_sha))
+        connection.executemany(
+            '''UPDATE "Annotation" SET "line_number" = ?, "blob_sha" = ?
+               WHERE "id" = ? AND "blob_sha" = ?''',
+            moves)
+        merged = collections.OrderedDict()
+        for target_id, annotation_id, old_sha in merges:
+            deleted = connection.execute(
+                '''DELETE FROM "Annotation" WHERE "id" = ? AND "blob_sha" = ?''',
+                (annotation_id, old_sha)).rowcount
+            # Another process may have re-anchored it already.
+            if deleted:
+                merged.setdefault(target_id, [contents[target_id]]).append(
+                    contents[annotation_id])
+        connection.executemany(
+            '''UPDATE "Annotation" SET "content" = ?, "content_html" = '',
+               "content_html_version" = NULL WHERE "id" = ?''',
+            [('\n\n'.join(parts), target_id) for target_id, parts in merged.items()])
+        connection.execute(
+            '''UPDATE "SourceFile" SET "annotation_count" =
+                   (SELECT COUNT(*) FROM "Annotation" WHERE "source_file" = ?)
+               WHERE "id" = ?''',
+            (source_file_id, source_file_id))
+        orm.commit()
+    return len(stale)
+
+def fetch_source(owner, repo, filepath, tree=None):
+    backend = repository_backend()
+    blob_sha = backend.blob_sha(owner, repo, filepath, tree=tree)
+    source_code = backend.blob(owner, repo, blob_sha)
+    return SourceCode(owner, repo, filepath, source_code=source_code, blob_sha=blob_sha)
+
+class Prefetcher(object):
+    """Warms the github and highlight caches with the files of a repository
+    that the user is likely to view next, in a small pool of background
+    threads. Starting a new batch cancels any earlier one, so at most one
+    batch is ever queued. We stop fetching altogether while github reports
+    that fewer than `rate_limit_reserve` requests remain, those are better
+    spent on the pages the user actually asks for."""
+    def __init__(self, client, workers, max_files, max_file_size, rate_limit_reserve):
+        self.client = client
+        self.workers = workers
+        self.max_files = max_files
+        self.max_file_size = max_file_size
+        self.rate_limit_reserve = rate_limit_reserve
+        self.prefetched = 0
+        self.failed = 0
+        self._executor = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {'prefetched': self.prefetched, 'failed': self.failed}
+
+    def rate_limited(self):
+        remaining = self.client.rate_limit_remaining
+        return remaining is not None and remaining < self.rate_limit_reserve
+
+    def candidates(self, tree, annotation_counts):
+        """The paths of the blobs worth prefetching, best first: annotated
+        files, most annotated first, then the others smallest first as they
+        are the cheapest."""
+        blobs = {entry['path']: entry for entry in tree.entries
+                 if entry['type'] == 'blob' and
+                    entry.get('size', 0) <= self.max_file_size}
+        annotated = [path for path, _count in annotation_counts.most_annotated()
+                     if path in blobs]
+        others = sorted(
+            (entry for path, entry in blobs.items()
+             if path not in annotation_counts.files),
+            key=lambda entry: (entry.get('size', 0), entry['path'])
             )
-        annotations = list(query)
-    repo = Repo(owner, repo_name)
-    return flask.render_template('repo-report.jinja', annotations=annotations, repo=repo)
+        paths = annotated + [entry['path'] for entry in others]
+        return paths[:self.max_files]
+
+    def prefetch(self, owner, repo, paths, tree=None):
+        with self._lock:
+            self._cancelled.set()
+            self._cancelled = cancelled = threading.Event()
+            if self._executor is None:
+                # Created lazily so that no threads are started on import.
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers)
+            for path in paths:
+                self._executor.submit(self._fetch, owner, repo, path, tree, cancelled)
+
+    def prefetch_tree(self, owner, repo, tree, annotation_counts):
+        self.prefetch(owner, repo, self.candidates(tree, annotation_counts), tree=tree)
+
+    def _fetch(self, owner, repo, path, tree, cancelled):
+        if cancelled.is_set():
+            return
+        if self.rate_limited():
+            cancelled.set()
+            return
+        try:
+            fetch_source(owner, repo, path, tree=tree)
+        except (requests.RequestException, werkzeug.exceptions.NotFound):
+            self.failed += 1
+        else:
+            self.prefetched += 1
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled.set()
+
+    def shutdown(self):
+        with self._lock:
+            self._cancelled.set()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+application.config['PREFETCH_ENABLED'] = False
+application.config['PREFETCH_WORKERS'] = 4
+application.config['PREFETCH_MAX_FILES'] = 20
+application.config['PREFETCH_MAX_FILE_SIZE'] = 512 * 1024
+application.config['PREFETCH_RATE_LIMIT_RESERVE'] = 500
+prefetcher = Prefetcher(
+    github,
+    workers=application.config['PREFETCH_WORKERS'],
+    max_files=application.config['PREFETCH_MAX_FILES'],
+    max_file_size=application.config['PREFETCH_MAX_FILE_SIZE'],
+    rate_limit_reserve=application.config['PREFETCH_RATE_LIMIT_RESERVE']
+    )
 
+application.config['SOURCE_WINDOW_THRESHOLD'] = 5000
+application.config['SOURCE_WINDOW_LINES'] = 500
 
 @application.route("/view-source/<owner>/<repo>/<path:filepath>", methods=['GET'])
 def view_source(owner, repo, filepath):
-    repo_url = 'https://api.github.com/repos/{0}/{1}'.format(owner, repo)
-    gh_resp = requests.get('{0}/contents/{1}'.format(repo_url, filepath))
-    gh_json = gh_resp.json()
-    source_contents = gh_json['content']
-    source_code = base64.b64decode(source_contents)
-    source = SourceCode(owner, repo, filepath, source_code=source_code)
-    return flask.render_template('view-source.jinja', source=source)
+    """Annotations are rendered inline with the source, unless the page is
+    asked for with '?annotations=fetch', in which case the page fetches them
+    itself with 'get_annotations'. Files with more than
+    SOURCE_WINDOW_THRESHOLD lines are shown a window at a time, centred on
+    '?line=N' if given, the page then loads further lines with 'source_lines'
+    as it is scrolled. The page is streamed out as the lines are rendered.
+    Annotations made against an earlier version of the file are first moved
+    to the corresponding lines of this one."""
+    source = fetch_source(owner, repo, filepath)
+    reanchor_annotations(owner, repo, filepath, source.blob_sha)
+    fetch_annotations = flask.request.args.get('annotations') == 'fetch'
+    start, stop = None, None
+    if source.num_lines > application.config['SOURCE_WINDOW_THRESHOLD']:
+        window_lines = application.config['SOURCE_WINDOW_LINES']
+        line = flask.request.args.get('line', 0, type=int)
+        start = max(0, line - window_lines // 2)
+        source.set_window(start, start + window_lines)
+        start, stop = source.window
+    if not fetch_annotations:
+        source.annotations = file_annotations(owner, repo, filepath, start=start, stop=stop)
+    return stream_template(
+        'view-source.jinja', source=source,
+        fetch_annotations=fetch_annotations
+        )
+
+@application.route("/source-lines/<owner>/<repo>/<path:filepath>", methods=['GET'])
+def source_lines(owner, repo, filepath):
+    """Returns the rendered html, annotations included, of the lines of a file
+    in the range [start, stop). This is how the windowed view of a large file
+    fetches more lines, so the range is limited to SOURCE_WINDOW_LINES."""
+    window_lines = application.config['SOURCE_WINDOW_LINES']
+    start = flask.request.args.get('start', 0, type=int)
+    stop = flask.request.args.get('stop', start + window_lines, type=int)
+    stop = min(stop, start + window_lines)
+    source = fetch_source(owner, repo, filepath)
+    reanchor_annotations(owner, repo, filepath, source.blob_sha)
+    start, stop = source.clamp_range(start, stop)
+    source.annotations = file_annotations(owner, repo, filepath, start=start, stop=stop)
+    return success_response(results={
+        'start': start,
+        'stop': stop,
+        'num_lines': source.num_lines,
+        'html': source.render_lines(start, stop)
+        })
 
 @application.route("/get-annotations", methods=['POST'])
 def get_annotations():
@@ -222,29 +2247,36 @@ class SourceSpecifierForm(flask_wtf.FlaskForm):
     repo = StringField('Repository', [InputRequired()])
     filepath = StringField('Filepath', [InputRequired()])
 
+    def source_file(self, create=False):
+        if create:
+            return SourceFile.get_or_create(self.repo_owner.data, self.repo.data, self.filepath.data)
+        return SourceFile.lookup(self.repo_owner.data, self.repo.data, self.filepath.data)
+
     def annotations_query(self):
         return orm.select(
             a for a in Annotation
-            if a.repo_owner == self.repo_owner.data and
-               a.repo == self.repo.data and
-               a.filepath == self.filepath.data
-            )
+            if a.source_file.repository.owner == self.repo_owner.data and
+               a.source_file.repository.name == self.repo.data and
+               a.source_file.path == self.filepath.data
+            ).order_by(Annotation.line_number)
 
 
 class AnnotationSpecifierForm(SourceSpecifierForm):
-    line_number = StringField('Line number', [InputRequired()])
+    line_number = IntegerField('Line number', [InputRequired()])
 
     def annotations_query(self):
         return orm.select(
             a for a in Annotation
-            if a.repo_owner == self.repo_owner.data and
-               a.repo == self.repo.data and
-               a.filepath == self.filepath.data and
+            if a.source_file.repository.owner == self.repo_owner.data and
+               a.source_file.repository.name == self.repo.data and
+               a.source_file.path == self.filepath.data and
                a.line_number == self.line_number.data
             )
 
 class AnnotationForm(AnnotationSpecifierForm):
     content = StringField('Content', [InputRequired()])
+    # The blob the line number refers to, if the client knows it.
+    blob_sha = StringField('Blob SHA')
 
 
 @application.route("/save-annotation", methods=['POST'])
@@ -254,23 +2286,23 @@ def save_annotation():
         return bad_request_response(message='You must provide appropriate data.')
 
     with orm.db_session:
+        source_file = form.source_file(create=True)
         annotation = Annotation.get(
-            repo = form.repo.data,
-            repo_owner = form.repo_owner.data,
-            filepath = form.filepath.data,
+            source_file = source_file,
             line_number = form.line_number.data,
             )
         if annotation:
             # For now assume one.
             annotation.content = form.content.data
+            annotation.blob_sha = form.blob_sha.data or ''
         else:
             annotation = Annotation(
-                repo = form.repo.data,
-                repo_owner = form.repo_owner.data,
-                filepath = form.filepath.data,
+                source_file = source_file,
                 line_number = form.line_number.data,
-                content = form.content.data
+                content = form.content.data,
+                blob_sha = form.blob_sha.data or ''
                 )
+            source_file.annotation_count += 1
         orm.commit()
     return success_response()
 
@@ -282,19 +2314,347 @@ def delete_annotation():
         return bad_request_response(message='You must provide appropriate data.')
 
     with orm.db_session:
-        annotation = Annotation.get(
-            repo = form.repo.data,
-            repo_owner = form.repo_owner.data,
-            filepath = form.filepath.data,
+        source_file = form.source_file()
+        annotation = source_file and Annotation.get(
+            source_file = source_file,
             line_number = form.line_number.data,
             )
         if annotation:
             annotation.delete()
+            source_file.annotation_count -= 1
             orm.commit()
     return success_response()
 
+# The largest value Pony will store in the (32 bit) line number column.
+max_line_number = 2 ** 31 - 1
+
+def is_line_number(line_number):
+    """Line numbers count from 0, as the 'code-line-N' ids do. Note that json's
+    true and false are ints as far as isinstance is concerned."""
+    return (isinstance(line_number, int) and not isinstance(line_number, bool) and
+            0 <= line_number <= max_line_number)
+
+def parse_annotation_edits(data):
+    """Returns the (upserts, deletes) of a batch of annotation edits, where
+    upserts is a dictionary mapping line numbers to content and deletes is a
+    set of line numbers. Raises ValueError if the edits are malformed."""
+    upserts = {}
+    for upsert in data.get('upserts', []):
+        line_number = upsert['line_number']
+        content = upsert['content']
+        if not is_line_number(line_number) or not isinstance(content, str) or not content:
+            raise ValueError('Each upsert needs a valid line number and some content.')
+        upserts[line_number] = content
+    deletes = set(data.get('deletes', []))
+    if not all(is_line_number(line_number) for line_number in deletes):
+        raise ValueError('Deletes must be valid line numbers.')
+    return upserts, deletes
+
+@application.route("/save-annotations", methods=['POST'])
+def save_annotations():
+    """Applies a batch of edits to the annotations of one source file, in a
+    single transaction. The json body specifies the source file as for
+    'save_annotation' along with a list of 'upserts', each a dictionary with a
+    'line_number' and 'content', and a list of line numbers to delete. The
+    client coalesces edits made in quick succession into one of these. The
+    optional 'blob_sha' is the blob the line numbers refer to."""
+    data = flask.request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return bad_request_response(message='You must provide a json object.')
+    specifier = {field: data.get(field) for field in ['repo_owner', 'repo', 'filepath']}
+    form = SourceSpecifierForm(MultiDict(specifier))
+    if not form.validate():
+        return bad_request_response(message='You must provide a filename.')
+    try:
+        upserts, deletes = parse_annotation_edits(data)
+    except (KeyError, TypeError, ValueError) as error:
+        return bad_request_response(message=str(error))
+    blob_sha = data.get('blob_sha') or ''
+    if not isinstance(blob_sha, str):
+        return bad_request_response(message='The blob SHA must be a string.')
+
+    with orm.db_session:
+        source_file = form.source_file(create=bool(upserts))
+        if source_file is None:
+            # Nothing was ever stored for this file, so nothing to delete.
+            return success_response()
+        line_numbers = set(upserts) | deletes
+        existing = {
+            a.line_number: a for a in orm.select(
+                a for a in Annotation
+                if a.source_file == source_file and a.line_number in line_numbers
+                )
+            }
+        for line_number, content in upserts.items():
+            annotation = existing.get(line_number)
+            if annotation:
+                annotation.content = content
+                annotation.blob_sha = blob_sha
+            else:
+                Annotation(source_file=source_file, line_number=line_number,
+                           content=content, blob_sha=blob_sha)
+                source_file.annotation_count += 1
+        for line_number in deletes - set(upserts):
+            annotation = existing.get(line_number)
+            if annotation:
+                annotation.delete()
+                source_file.annotation_count -= 1
+        orm.commit()
+    return success_response()
+
+class SearchResult(object):
+    def __init__(self, owner, repo, filepath, line_number, content, snippet):
+        self.owner = owner
+        self.repo = repo
+        self.filepath = filepath
+        self.line_number = line_number
+        self.content = content
+        self.snippet = snippet
+
+    def jsonify(self):
+        return {'repo_owner': self.owner,
+                'repo': self.repo,
+                'filepath': self.filepath,
+                'line_number': self.line_number,
+                'content': self.content,
+                'snippet': self.snippet}
+
+
+# Used to mark matches in search snippets, so that we can escape the snippet
+# before turning these into html.
+match_start_marker = '\x02'
+match_end_marker = '\x03'
+
+def search_query_expression(text):
+    """Turn what the user typed into an FTS5 query. Each word is quoted so that
+    punctuation cannot produce a syntax error, and every word must match. A
+    word ending in '*' is a prefix search."""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*') and len(word) > 1
+        word = word.rstrip('*') if prefix else word
+        terms.append('"{}"{}'.format(word.replace('"', '""'), '*' if prefix else ''))
+    return ' '.join(terms)
+
+def search_annotations(text, owner=None, repo=None, path=None, page=1, page_size=20):
+    """Search annotation content via the full-text index, best matches first.
+    Returns (results, has_more). If path is given, results are restricted to
+    that file or the files beneath that directory. Must be called within a
+    db_session."""
+    expression = search_query_expression(text)
+    if not expression:
+        return [], False
+    parameters = {
+        'expression': expression,
+        'owner': owner,
+        'repo': repo,
+        'path': path,
+        'path_prefix': (path or '').rstrip('/') + '/',
+        'limit': page_size + 1,
+        'offset': (max(1, page) - 1) * page_size,
+        'start': match_start_marker,
+        'end': match_end_marker,
+        }
+    conditions = ['"AnnotationSearch" MATCH $expression']
+    if owner:
+        conditions.append('r."owner" = $owner')
+    if repo:
+        conditions.append('r."name" = $repo')
+    if path:
+        conditions.append('''(f."path" = $path OR
+            substr(f."path", 1, length($path_prefix)) = $path_prefix)''')
+    sql = '''SELECT r."owner", r."name", f."path", a."line_number", a."content",
+               snippet("AnnotationSearch", 0, $start, $end, '...', 12)
+        FROM "AnnotationSearch" s
+        JOIN "Annotation" a ON a."id" = s."rowid"
+        JOIN "SourceFile" f ON f."id" = a."source_file"
+        JOIN "Repository" r ON r."id" = f."repository"
+        WHERE {}
+        ORDER BY s."rank"
+        LIMIT $limit OFFSET $offset'''.format(' AND '.join(conditions))
+    rows = database.select(sql, parameters)
+    results = []
+    for owner, repo, filepath, line_number, content, snippet in rows[:page_size]:
+        snippet = str(markupsafe.escape(snippet))
+        snippet = snippet.replace(match_start_marker, '<mark>')
+        snippet = snippet.replace(match_end_marker, '</mark>')
+        results.append(SearchResult(owner, repo, filepath, line_number, content, snippet))
+    return results, len(rows) > page_size
+
+class SearchForm(flask_wtf.FlaskForm):
+    q = StringField('Search', [InputRequired()])
+    owner = StringField('Repository Owner')
+    repo = StringField('Repository')
+    path = StringField('Path')
+    page = IntegerField('Page', default=1)
+
+    class Meta:
+        # This is a GET form, so there is nothing to protect.
+        csrf = False
+
+@application.route("/search-annotations", methods=['GET'])
+def search_annotations_view():
+    form = SearchForm(flask.request.args)
+    if not form.validate():
+        return bad_request_response(message='You must provide something to search for.')
+    with orm.db_session:
+        results, has_more = search_annotations(
+            form.q.data,
+            owner=form.owner.data or None,
+            repo=form.repo.data or None,
+            path=form.path.data or None,
+            page=form.page.data or 1
+            )
+    return success_response(results={
+        'results': [result.jsonify() for result in results],
+        'page': form.page.data or 1,
+        'has_more': has_more
+        })
+
+@appraisal.command()
+@click.argument('text')
+@click.option('--owner', default=None)
+@click.option('--repo', default=None)
+@click.option('--path', default=None)
+@click.option('--page', default=1)
+@click.option('--db-file', default='play.sqlite')
+def search(text, owner, repo, path, page, db_file):
+    """Search the content of the stored annotations."""
+    set_database(db_file=db_file)
+    with orm.db_session:
+        results, has_more = search_annotations(text, owner=owner, repo=repo, path=path, page=page)
+    for result in results:
+        snippet = result.snippet.replace('<mark>', '').replace('</mark>', '')
+        click.echo('{}/{} {}:{}  {}'.format(
+            result.owner, result.repo, result.filepath, result.line_number,
+            markupsafe.Markup(snippet).unescape().replace('\n', ' ')
+            ))
+    if has_more:
+        click.echo('... more results with --page {}'.format(page + 1))
+
+export_fields = ['repo_owner', 'repo', 'filepath', 'line_number', 'content', 'blob_sha']
+
+def exported_annotations(connection, owner=None, repo=None):
+    """Generates the annotations, optionally only those of one owner or one
+    repository, as dicts of `export_fields`. Rows come straight from sqlite,
+    one repository after another, with no entity created for each one."""
+    rows = connection.execute(
+        '''SELECT r."owner", r."name", f."path", a."line_number", a."content",
+                  a."blob_sha"
+           FROM "Annotation" a
+           JOIN "SourceFile" f ON a."source_file" = f."id"
+           JOIN "Repository" r ON f."repository" = r."id"
+           WHERE (:owner IS NULL OR r."owner" = :owner) AND
+                 (:repo IS NULL OR r."name" = :repo)
+           ORDER BY r."owner", r."name", f."path", a."line_number"''',
+        {'owner': owner, 'repo': repo})
+    for row in rows:
+        yield dict(zip(export_fields, row))
+
+def import_annotation_batch(connection, batch, source_file_ids):
+    """Upserts a batch of exported annotations in a single transaction. An
+    annotation replaces any existing one on the same line of the same file.
+    The html of new or changed content is left to be rendered when the
+    annotation is next read. `source_file_ids` remembers the source files
+    we have seen, between batches."""
+    connection.execute('BEGIN')
+    try:
+        for annotation in batch:
+            file_key = (annotation['repo_owner'], annotation['repo'], annotation['filepath'])
+            source_file_id = source_file_ids.get(file_key)
+            if source_file_id is None:
+                connection.execute(
+                    'INSERT OR IGNORE INTO "Repository" ("owner", "name") VALUES (?, ?)',
+                    file_key[:2])
+                connection.execute(
+                    '''INSERT OR IGNORE INTO "SourceFile" ("repository", "path", "annotation_count")
+                       SELECT "id", ?, 0 FROM "Repository" WHERE "owner" = ? AND "name" = ?''',
+                    (file_key[2],) + file_key[:2])
+                source_file_id = connection.execute(
+                    '''SELECT f."id" FROM "SourceFile" f JOIN "Repository" r ON f."repository" = r."id"
+                       WHERE r."owner" = ? AND r."name" = ? AND f."path" = ?''',
+                    file_key).fetchone()[0]
+                source_file_ids[file_key] = source_file_id
+            blob_sha = annotation.get('blob_sha', '')
+            existing = connection.execute(
+                '''SELECT "id", "content", "blob_sha" FROM "Annotation"
+                   WHERE "source_file" = ? AND "line_number" = ?''',
+                (source_file_id, annotation['line_number'])).fetchone()
+            if existing is None:
+                connection.execute(
+                    '''INSERT INTO "Annotation"
+                       ("source_file", "line_number", "content", "content_html",
+                        "content_html_version", "blob_sha")
+                       VALUES (?, ?, ?, '', NULL, ?)''',
+                    (source_file_id, annotation['line_number'], annotation['content'], blob_sha))
+            elif existing[1] != annotation['content']:
+                connection.execute(
+                    '''UPDATE "Annotation" SET "content" = ?, "content_html" = '',
+                       "content_html_version" = NULL, "blob_sha" = ? WHERE "id" = ?''',
+                    (annotation['content'], blob_sha, existing[0]))
+            elif existing[2] != blob_sha:
+                connection.execute(
+                    'UPDATE "Annotation" SET "blob_sha" = ? WHERE "id" = ?',
+                    (blob_sha, existing[0]))
+        touched = {source_file_ids[(a['repo_owner'], a['repo'], a['filepath'])] for a in batch}
+        connection.executemany(
+            '''UPDATE "SourceFile" SET "annotation_count" =
+                   (SELECT COUNT(*) FROM "Annotation" WHERE "source_file" = "SourceFile"."id")
+               WHERE "id" = ?''',
+            [(source_file_id,) for source_file_id in touched])
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+@appraisal.command(name='export')
+@click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--owner', default=None)
+@click.option('--repo', default=None)
+@click.option('--db-file', default='play.sqlite')
+def export_annotations(output, owner, repo, db_file):
+    """Write the annotations, as JSON lines, to OUTPUT (by default stdout)."""
+    set_database(db_file=db_file)
+    connection = sqlite3.connect(generated_file_path(db_file))
+    try:
+        for annotation in exported_annotations(connection, owner=owner, repo=repo):
+            output.write(json.dumps(annotation))
+            output.write('\n')
+    finally:
+        connection.close()
+
+@appraisal.command(name='import')
+@click.argument('input_file', metavar='INPUT', type=click.File('r', encoding='utf-8'), default='-')
+@click.option('--batch-size', default=5000)
+@click.option('--db-file', default='play.sqlite')
+def import_annotations(input_file, batch_size, db_file):
+    """Read annotations, as written by 'export', from INPUT (by default stdin)
+    and add them to the database, replacing any on the same lines."""
+    set_database(db_file=db_file)
+    connection = sqlite3.connect(generated_file_path(db_file), isolation_level=None)
+    source_file_ids = {}
+    imported = 0
+    try:
+        lines = (line for line in input_file if line.strip())
+        while True:
+            batch = [json.loads(line) for line in itertools.islice(lines, batch_size)]
+            if not batch:
+                break
+            import_annotation_batch(connection, batch, source_file_ids)
+            imported += len(batch)
+    finally:
+        connection.close()
+    click.echo('Imported {} annotations'.format(imported), err=True)
+
 @appraisal.command()
-def runserver():
+@click.option('--prefetch', is_flag=True, default=False,
+              help="Fetch likely files in the background when a repository is viewed.")
+@click.option('--backend', type=click.Choice(sorted(repository_backends)), default='github',
+              help="Read repositories through the github api or from local mirror clones.")
+def runserver(prefetch, backend):
+    if prefetch:
+        application.config['PREFETCH_ENABLED'] = True
+    application.config['REPOSITORY_BACKEND'] = backend
     extra_dirs = ['static/', 'templates/']
     extra_files = extra_dirs[:]
     for extra_dir in extra_dirs:
@@ -311,6 +2671,72 @@ def runserver():
         extra_files=extra_files
         )
 
+application.config['SERVE_WORKERS'] = (os.cpu_count() or 1) * 2 + 1
+application.config['SERVE_THREADS'] = 4
+application.config['SERVE_TIMEOUT'] = 60
+application.config['SERVE_KEEPALIVE'] = 5
+application.config['SERVE_MAX_REQUESTS'] = 1000
+
+@appraisal.command()
+@click.option('--host', default='0.0.0.0')
+@click.option('--port', default=8080)
+@click.option('--workers', default=None, type=int,
+              help="Number of worker processes, defaults to SERVE_WORKERS.")
+@click.option('--threads', default=None, type=int,
+              help="Number of threads in each worker, defaults to SERVE_THREADS.")
+@click.option('--timeout', default=None, type=int,
+              help="Seconds before a stuck worker is restarted.")
+@click.option('--keepalive', default=None, type=int,
+              help="Seconds to hold an idle keep-alive connection open.")
+@click.option('--max-requests', default=None, type=int,
+              help="Restart each worker after this many requests, 0 for never.")
+@click.option('--db-file', default='play.sqlite')
+@click.option('--prefetch', is_flag=True, default=False)
+@click.option('--backend', type=click.Choice(sorted(repository_backends)), default='github')
+def serve(host, port, workers, threads, timeout, keepalive, max_requests, db_file,
+          prefetch, backend):
+    """Serve the application for real, with gunicorn, in several worker
+    processes each with several threads, and without the debugger or the
+    reloader of 'runserver'."""
+    try:
+        import gunicorn.app.base
+    except ImportError:
+        raise click.ClickException('serve needs gunicorn, try: pip install gunicorn')
+
+    config = application.config
+    options = {
+        'bind': '{}:{}'.format(host, port),
+        'workers': workers or config['SERVE_WORKERS'],
+        'threads': threads or config['SERVE_THREADS'],
+        'worker_class': 'gthread',
+        'timeout': config['SERVE_TIMEOUT'] if timeout is None else timeout,
+        'keepalive': config['SERVE_KEEPALIVE'] if keepalive is None else keepalive,
+        'max_requests': config['SERVE_MAX_REQUESTS'] if max_requests is None else max_requests,
+        # So that the workers do not all restart at once.
+        'max_requests_jitter': 50,
+        'accesslog': '-',
+        }
+
+    class StandaloneApplication(gunicorn.app.base.BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return application
+
+    application.debug = False
+    if prefetch:
+        config['PREFETCH_ENABLED'] = True
+    config['REPOSITORY_BACKEND'] = backend
+    # Migrate and bind once, here in the master, and then close our connection
+    # before the workers are forked. Pony opens connections lazily, one per
+    # thread, so each worker thread then opens its own, rather than sharing
+    # one inherited from the master.
+    set_database(db_file=db_file)
+    database.disconnect()
+    StandaloneApplication().run()
+
 
 # Now for some testing.
 from collections import OrderedDict
@@ -323,15 +2749,15 @@ from selenium.common.exceptions import NoSuchElementException, InvalidElementSta
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.keys import Keys
 import pytest
+import click.testing
 # Currently just used for the temporary hack to quit the phantomjs process
 # see below in quit_driver.
 import signal
 
-import threading
+import socketserver
 import wsgiref.simple_server
 
 import unittest.mock as mock
-import uuid
 
 def get_new_unique_identifier():
     return uuid.uuid4().hex
@@ -339,19 +2765,28 @@ def get_new_unique_identifier():
 
 def setup_testing(db_file='test.db'):
     reset = db_file == 'test.db'
-    set_database(db_file=db_file, reset=reset)
+    # Pony can only bind one database per process, the browser tests and the
+    # offline tests share whichever is bound first.
+    if database.provider is None:
+        set_database(db_file=db_file, reset=reset)
     application.config['TESTING'] = True
     port = application.config['TEST_SERVER_PORT']
     application.config['SERVER_NAME'] = 'localhost:{}'.format(port)
 
 
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    """Handles each request in its own thread, so that one slow request (say
+    a github fetch) does not hold up the others."""
+    daemon_threads = True
+
 class ServerThread(threading.Thread):
     def setup(self, db_file='test.db'):
         setup_testing(db_file=db_file)
         self.port = application.config['TEST_SERVER_PORT']
 
     def run(self):
-        self.httpd = wsgiref.simple_server.make_server('localhost', self.port, application)
+        self.httpd = wsgiref.simple_server.make_server(
+            'localhost', self.port, application, server_class=ThreadingWSGIServer)
         self.httpd.serve_forever()
 
     def stop(self):
@@ -461,6 +2896,11 @@ class BrowserClient(object):
         condition = expected_conditions.invisibility_of_element_located(element_spec)
         return self.wait_for_condition(condition, **kwargs)
 
+    def wait_for_annotations_saved(self, **kwargs):
+        """Annotation edits are batched up by the page before being sent, so
+        wait until there are none pending before checking the database."""
+        return self.wait_for_element_to_be_invisible('body.annotations-pending', **kwargs)
+
     def wait_for_element(self, selector, **kwargs):
         element_spec = (By.CSS_SELECTOR, selector)
         condition = expected_conditions.presence_of_element_located(element_spec)
@@ -647,6 +3087,11 @@ def client(request):
     request.addfinalizer(client.finalise)
     return client
 
+@pytest.fixture(scope='module')
+def offline_database():
+    """For tests which need the database but neither a browser nor github."""
+    setup_testing()
+
 def check_view_repository(client, repo_owner, repo):
     repo_url = 'https://github.com/{}/{}'.format(repo_owner, repo)
     form_input = OrderedDict(repo_url = repo_url)
@@ -677,18 +3122,23 @@ class AnnotDesc(object):
         # I don't know if perhaps an ApplicationClient should just mimic the selenium
         # ActionChains protocol?
         ActionChains(client.driver).key_down(Keys.CONTROL).key_up(Keys.CONTROL).perform()
+        client.wait_for_annotations_saved()
 
     def update_annotation(self, client, new_text, clear=True):
         self.content = new_text
         input_css = '.annotation[code-line="{}"] .annotation-input'.format(self.code_line_id)
         client.fill_in_text_input_by_css(input_css, new_text, clear=clear)
         ActionChains(client.driver).key_down(Keys.CONTROL).key_up(Keys.CONTROL).perform()
+        client.wait_for_annotations_saved()
 
-    def get_db_annotation(self, **kwargs):
+    def get_db_annotation(self, repo, repo_owner, filepath, **kwargs):
         with orm.db_session:
-            defaults = dict(content=self.content, line_number=self.code_line_id)
+            source_file = SourceFile.lookup(repo_owner, repo, filepath)
+            if source_file is None:
+                return None
+            defaults = dict(content=self.content, line_number=self.line_number)
             defaults.update(kwargs)
-            db_annotation = Annotation.get(**defaults)
+            db_annotation = Annotation.get(source_file=source_file, **defaults)
         return db_annotation
 
 def click_source_file(client, filepath):
@@ -715,7 +3165,7 @@ def test_main(client):
     client.logger.info("""Fill in the text of the annotation and check that it \
     and check that it exists in the database.""")
     first_text = 'Here I am to save the day.'
-    annotation = AnnotDesc(first_text, '3')
+    annotation = AnnotDesc(first_text, 3)
     annotation.create_annotation(client)
     assert annotation.get_db_annotation(
         repo = repo,
@@ -747,6 +3197,7 @@ def test_main(client):
 
     client.logger.info('Delete the annotation and check that it is not in the database.')
     client.click('.delete-annotation')
+    client.wait_for_annotations_saved()
     db_annotation = annotation.get_db_annotation(
         repo = repo,
         repo_owner = repo_owner,
@@ -771,8 +3222,8 @@ def test_report(client):
 
     client.logger.info('Create a couple of annotations.')
     main_annotations = [
-        AnnotDesc('This is line number 3', '3'),
-        AnnotDesc('This is line number 5', '5')
+        AnnotDesc('This is line number 3', 3),
+        AnnotDesc('This is line number 5', 5)
         ]
     for annotation in main_annotations:
         annotation.create_annotation(client)
@@ -787,8 +3238,8 @@ def test_report(client):
 
     client.logger.info('Create a couple more annotations')
     base_template_annotations = [
-        AnnotDesc('This is line number 8', '8'),
-        AnnotDesc('This is line number 10', '10')
+        AnnotDesc('This is line number 8', 8),
+        AnnotDesc('This is line number 10', 10)
         ]
     for annotation in base_template_annotations:
         annotation.create_annotation(client)
@@ -800,6 +3251,396 @@ def test_report(client):
     contents = [a.content for a in main_annotations + base_template_annotations]
     client.check_css_contains_texts('.annotation', *contents)
 
+def create_origin(origin):
+    """Creates a git repository at `origin` to stand in for github. Returns a
+    function which commits a file, given its path and contents, to it."""
+    def git(*args):
+        subprocess.run(['git', '-C', origin] + list(args), check=True,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def commit_file(path, contents):
+        os.makedirs(os.path.dirname(os.path.join(origin, path)), exist_ok=True)
+        with open(os.path.join(origin, path), 'w') as source_file:
+            source_file.write(contents)
+        git('add', path)
+        git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+            'commit', '--quiet', '-m', 'Update {}'.format(path))
+    os.makedirs(origin)
+    git('init', '--quiet')
+    git('checkout', '--quiet', '-b', 'master')
+    return commit_file
+
+def test_local_mirror_backend(tmpdir):
+    """Unlike the other tests this needs neither a browser nor github, the
+    'remote' is a repository we create locally."""
+    origin = str(tmpdir.join('origin'))
+    commit_file = create_origin(origin)
+    commit_file('package/module.py', 'x = 1\n')
+
+    backend = LocalMirrorBackend(
+        str(tmpdir.join('mirrors')), remote_url=origin, fetch_interval=0,
+        size=1024 * 1024
+        )
+    tree = backend.branch_tree('owner', 'repo')
+    assert tree.node('package').type == 'tree'
+    blob_sha = backend.blob_sha('owner', 'repo', 'package/module.py')
+    assert backend.blob('owner', 'repo', blob_sha) == b'x = 1\n'
+    assert tree.node('package/module.py').size == len(b'x = 1\n')
+
+    # A new commit is picked up by an incremental fetch into the mirror.
+    commit_file('package/module.py', 'x = 2\n')
+    blob_sha = backend.blob_sha('owner', 'repo', 'package/module.py')
+    assert backend.blob('owner', 'repo', blob_sha) == b'x = 2\n'
+    with pytest.raises(werkzeug.exceptions.NotFound):
+        backend.blob_sha('owner', 'repo', 'package/missing.py')
+    with pytest.raises(werkzeug.exceptions.NotFound):
+        backend.blob('owner', 'repo', '0' * 40)
+
+    # A mirror left half cloned by an earlier failure is cloned again.
+    broken_path = backend.mirror_path('owner', 'broken')
+    os.makedirs(os.path.join(broken_path, 'objects'))
+    tree = backend.branch_tree('owner', 'broken')
+    assert tree.node('package/module.py').size == len(b'x = 2\n')
+    # Neither the temporary clone nor the broken mirror is left behind.
+    assert sorted(os.listdir(os.path.dirname(broken_path))) == ['broken.git', 'repo.git']
+
+def test_migrate_baseline_database(tmpdir):
+    """A database with the original schema, where line numbers were the ids of
+    the code line elements, is brought up to date when it is opened."""
+    database_filename = str(tmpdir.join('baseline.sqlite'))
+    connection = sqlite3.connect(database_filename)
+    connection.execute('''
+        CREATE TABLE "Annotation" (
+            "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "repo" TEXT NOT NULL,
+            "repo_owner" TEXT NOT NULL,
+            "filepath" TEXT NOT NULL,
+            "line_number" TEXT NOT NULL,
+            "content" TEXT NOT NULL
+            )''')
+    connection.executemany(
+        '''INSERT INTO "Annotation" ("repo", "repo_owner", "filepath", "line_number", "content")
+           VALUES (?, ?, ?, ?, ?)''',
+        [('repo', 'owner', 'main.py', 'code-line-3', 'A fine *function*'),
+         ('repo', 'owner', 'main.py', 'code-line-10', 'Another'),
+         ('repo', 'owner', 'util.py', 'code-line-0', 'A module docstring'),
+         ('other', 'owner', 'main.py', 'code-line-7', 'Elsewhere')])
+    connection.commit()
+    connection.close()
+
+    # Pony can only bind one database per process, so open it in another.
+    subprocess.run(
+        [sys.executable, '-c', 'import main; main.set_database({!r})'.format(database_filename)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+    connection = sqlite3.connect(database_filename)
+    try:
+        assert connection.execute('PRAGMA user_version').fetchone()[0] == len(migrations)
+        annotations = connection.execute(
+            '''SELECT r."name", f."path", a."line_number", a."content", a."blob_sha",
+                      a."content_html_version"
+               FROM "Annotation" a
+               JOIN "SourceFile" f ON a."source_file" = f."id"
+               JOIN "Repository" r ON f."repository" = r."id"
+               ORDER BY a."id"''').fetchall()
+        assert annotations == [
+            ('repo', 'main.py', 3, 'A fine *function*', '', None),
+            ('repo', 'main.py', 10, 'Another', '', None),
+            ('repo', 'util.py', 0, 'A module docstring', '', None),
+            ('other', 'main.py', 7, 'Elsewhere', '', None)]
+        counts = connection.execute(
+            '''SELECT r."name", f."path", f."annotation_count"
+               FROM "SourceFile" f JOIN "Repository" r ON f."repository" = r."id"
+               ORDER BY r."name", f."path"''').fetchall()
+        assert counts == [('other', 'main.py', 1), ('repo', 'main.py', 2), ('repo', 'util.py', 1)]
+        matches = connection.execute(
+            '''SELECT "rowid" FROM "AnnotationSearch"
+               WHERE "AnnotationSearch" MATCH 'functions' ''').fetchall()
+        assert matches == [(1,)]
+    finally:
+        connection.close()
+
+def test_export_import_round_trip(tmpdir):
+    """Runs the commands themselves, each in its own process as Pony can only
+    bind one database per process."""
+    def run_command(*args):
+        result = subprocess.run(
+            [sys.executable, 'main.py'] + list(args), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True)
+        return result.stdout.decode('utf-8')
+    def write_annotations(filename, annotations):
+        with open(filename, 'w', encoding='utf-8') as annotations_file:
+            for annotation in annotations:
+                annotations_file.write(json.dumps(annotation) + '\n')
+    def file_counts(database_filename):
+        connection = sqlite3.connect(database_filename)
+        try:
+            return connection.execute(
+                '''SELECT f."path", f."annotation_count" FROM "SourceFile" f
+                   ORDER BY f."path"''').fetchall()
+        finally:
+            connection.close()
+    def search(database_filename, text):
+        connection = sqlite3.connect(database_filename)
+        try:
+            return connection.execute(
+                '''SELECT a."line_number" FROM "AnnotationSearch" s
+                   JOIN "Annotation" a ON a."id" = s."rowid"
+                   WHERE "AnnotationSearch" MATCH ? ORDER BY a."line_number"''',
+                (text,)).fetchall()
+        finally:
+            connection.close()
+
+    annotations = [
+        dict(repo_owner='owner', repo='repo', filepath='main.py', line_number=1,
+             content='The *entry* point', blob_sha='a' * 40),
+        dict(repo_owner='owner', repo='repo', filepath='main.py', line_number=5,
+             content='Parses the arguments', blob_sha='a' * 40),
+        dict(repo_owner='owner', repo='repo', filepath='util.py', line_number=0,
+             content='Helpers', blob_sha=''),
+        ]
+    original = str(tmpdir.join('original.jsonl'))
+    write_annotations(original, annotations)
+    first_database = str(tmpdir.join('first.sqlite'))
+    run_command('import', original, '--db-file', first_database, '--batch-size', '2')
+    exported = str(tmpdir.join('exported.jsonl'))
+    run_command('export', exported, '--db-file', first_database)
+    with open(exported, encoding='utf-8') as exported_file:
+        assert [json.loads(line) for line in exported_file] == annotations
+
+    second_database = str(tmpdir.join('second.sqlite'))
+    run_command('import', exported, '--db-file', second_database)
+    run_command('import', exported, '--db-file', second_database)
+    assert file_counts(second_database) == [('main.py', 2), ('util.py', 1)]
+    assert search(second_database, 'argument') == [(5,)]
+
+    # Re-importing updates the content, or only the blob, of existing annotations.
+    annotations[1]['content'] = 'Validates the options'
+    annotations[2]['blob_sha'] = 'b' * 40
+    updated = str(tmpdir.join('updated.jsonl'))
+    write_annotations(updated, annotations[1:])
+    run_command('import', updated, '--db-file', second_database)
+    assert file_counts(second_database) == [('main.py', 2), ('util.py', 1)]
+    assert search(second_database, 'argument') == []
+    assert search(second_database, 'options') == [(5,)]
+    exported_lines = run_command('export', '--db-file', second_database).splitlines()
+    assert [json.loads(line) for line in exported_lines] == annotations
+
+def test_search_annotations(offline_database):
+    owner = get_new_unique_identifier()
+    with orm.db_session:
+        main_file = SourceFile.get_or_create(owner, 'repo', 'package/main.py')
+        other_file = SourceFile.get_or_create(owner, 'repo', 'package-extra/main.py')
+        annotations = [
+            Annotation(source_file=main_file, line_number=1, content='Parses "quoted" arguments'),
+            Annotation(source_file=main_file, line_number=2, content='Handles a:b (punctuation)!'),
+            Annotation(source_file=main_file, line_number=3, content='Configuration loading'),
+            Annotation(source_file=other_file, line_number=1, content='Parses the configuration'),
+            ]
+        other_repo_file = SourceFile.get_or_create(owner, 'other', 'package/main.py')
+        Annotation(source_file=other_repo_file, line_number=1, content='Parses elsewhere')
+
+    def search(text, **kwargs):
+        kwargs.setdefault('owner', owner)
+        with orm.db_session:
+            results, has_more = search_annotations(text, **kwargs)
+        return [(r.repo, r.filepath, r.line_number) for r in results], has_more
+
+    assert search_query_expression('a:b "x" conf*') == '"a:b" """x""" "conf"*'
+    assert search_query_expression('  ') == ''
+    assert search('') == ([], False)
+    assert search('"quoted"') == ([('repo', 'package/main.py', 1)], False)
+    assert search('a:b (punctuation)!') == ([('repo', 'package/main.py', 2)], False)
+    assert sorted(search('conf*', repo='repo')[0]) == [
+        ('repo', 'package-extra/main.py', 1), ('repo', 'package/main.py', 3)]
+    assert search('conf') == ([], False)
+    assert len(search('parses')[0]) == 3
+    assert search('parses', repo='other') == ([('other', 'package/main.py', 1)], False)
+    # A directory only matches the files beneath it, not its namesakes.
+    assert search('parses', repo='repo', path='package') == (
+        [('repo', 'package/main.py', 1)], False)
+    assert search('parses', repo='repo', path='package/') == (
+        [('repo', 'package/main.py', 1)], False)
+    assert search('parses', repo='repo', path='package/main.py') == (
+        [('repo', 'package/main.py', 1)], False)
+
+    first_page, has_more = search('parses', page_size=2)
+    assert len(first_page) == 2 and has_more
+    second_page, has_more = search('parses', page=2, page_size=2)
+    assert len(second_page) == 1 and not has_more
+    assert set(first_page).isdisjoint(second_page)
+
+    # The index follows updates and deletes.
+    with orm.db_session:
+        Annotation[annotations[2].id].content = 'Reads the settings'
+        Annotation[annotations[3].id].delete()
+    assert search('configuration') == ([], False)
+    assert search('settings') == ([('repo', 'package/main.py', 3)], False)
+
+def test_save_annotations(offline_database):
+    owner = get_new_unique_identifier()
+    source = {'repo_owner': owner, 'repo': 'repo', 'filepath': 'main.py'}
+    test_client = application.test_client()
+    def save(upserts=(), deletes=(), **fields):
+        batch = dict(source, upserts=list(upserts), deletes=list(deletes))
+        batch.update(fields)
+        return test_client.post('/save-annotations', data=json.dumps(batch),
+                                content_type='application/json')
+    def stored():
+        with orm.db_session:
+            source_file = SourceFile.lookup(owner, 'repo', 'main.py')
+            if source_file is None:
+                return None, {}
+            annotations = {a.line_number: a.content for a in source_file.annotations}
+            return source_file.annotation_count, annotations
+
+    # Deleting from a file we have never stored anything for is fine.
+    assert save(deletes=[1]).status_code == 200
+    assert stored() == (None, {})
+
+    response = save(upserts=[{'line_number': 1, 'content': 'One'},
+                             {'line_number': 2, 'content': 'Two'},
+                             {'line_number': 3, 'content': 'Three'}])
+    assert response.status_code == 200
+    assert stored() == (3, {1: 'One', 2: 'Two', 3: 'Three'})
+
+    response = save(upserts=[{'line_number': 2, 'content': 'Second'},
+                             {'line_number': 4, 'content': 'Four'}],
+                    deletes=[1, 4, 7])
+    assert response.status_code == 200
+    # An upsert wins over a delete of the same line in the same batch.
+    assert stored() == (3, {2: 'Second', 3: 'Three', 4: 'Four'})
+
+    for malformed in [dict(upserts=[{'line_number': '5', 'content': 'Five'}]),
+                      dict(upserts=[{'line_number': True, 'content': 'Five'}]),
+                      dict(upserts=[{'line_number': -1, 'content': 'Five'}]),
+                      dict(upserts=[{'line_number': 2 ** 31, 'content': 'Five'}]),
+                      dict(deletes=[True]),
+                      dict(deletes=[-2]),
+                      dict(deletes=[2 ** 40]),
+                      dict(upserts=[{'line_number': 5, 'content': ''}]),
+                      dict(upserts=[{'line_number': 5}]),
+                      dict(deletes=['2']),
+                      dict(filepath=''),
+                      dict(blob_sha=5)]:
+        assert save(**malformed).status_code == 400
+    response = test_client.post('/save-annotations', data='[]',
+                                content_type='application/json')
+    assert response.status_code == 400
+    assert stored() == (3, {2: 'Second', 3: 'Three', 4: 'Four'})
+
+    # Lines count from 0, up to whatever fits in the column.
+    response = save(upserts=[{'line_number': 0, 'content': 'First'},
+                             {'line_number': max_line_number, 'content': 'Last'}])
+    assert response.status_code == 200
+    assert stored() == (5, {0: 'First', 2: 'Second', 3: 'Three', 4: 'Four',
+                            max_line_number: 'Last'})
+
+def test_report_reanchors_annotations(offline_database, tmpdir):
+    """The report shows each annotation against the current source, even if
+    the file has changed since and nobody has viewed it."""
+    origin = str(tmpdir.join('origin'))
+    commit_file = create_origin(origin)
+    commit_file('notes.txt', 'alpha\nbeta\ngamma\n')
+    backend = LocalMirrorBackend(
+        str(tmpdir.join('mirrors')), remote_url=origin, fetch_interval=0,
+        size=1024 * 1024
+        )
+    owner = get_new_unique_identifier()
+    test_client = application.test_client()
+    with mock.patch.dict(repository_backends, {'test': backend}), \
+         mock.patch.dict(application.config, {'REPOSITORY_BACKEND': 'test'}):
+        batch = {'repo_owner': owner, 'repo': 'repo', 'filepath': 'notes.txt',
+                 'blob_sha': backend.blob_sha(owner, 'repo', 'notes.txt'),
+                 'upserts': [{'line_number': 1, 'content': 'About beta'}]}
+        response = test_client.post('/save-annotations', data=json.dumps(batch),
+                                    content_type='application/json')
+        assert response.status_code == 200
+
+        commit_file('notes.txt', 'new\nlines\nalpha\nbeta\ngamma\n')
+        response = test_client.get(make_url('view_repo_report', owner=owner, repo_name='repo'))
+        assert response.status_code == 200
+        report = response.get_data(as_text=True)
+    annotated_lines = re.findall(r'annotated-line">([^<]*)<', report)
+    assert annotated_lines == ['beta\n']
+    assert [a['line_number'] for a in file_annotations(owner, 'repo', 'notes.txt')] == [3]
+
+def test_highlighted_lines():
+    """Rendering the compact tokens, whole or a range of lines, gives exactly
+    what pygments itself would."""
+    sources = {
+        'python': '\n\ndef f(x):\n    """A docstring\n    over lines."""\r\n    return x < 1\n',
+        'html': '<div class="a">\n<!-- a\ncomment -->\n<p>&amp; text</p>\n</div>',
+        'c': '/* A\n * comment */\nint main(void) {\n\treturn 0;\n}\n',
+        'text': 'plain <text>\n\nwith & blank lines\n',
+        }
+    formatter = SourceCode.formatter
+    for lexer_name, source in sources.items():
+        lexer = pygments.lexers.get_lexer_by_name(lexer_name)
+        highlighted = lex_source(source, lexer.__class__)
+        lines = formatter.highlight_lines(lexer.get_tokens(source))
+        assert len(highlighted) == len(lines)
+        expected = pygments.highlight(source, lexer, formatter)
+        rendered = formatter.wrap_lines(highlighted.html_lines(0, len(highlighted), formatter))
+        assert rendered == expected
+        for start, stop in [(0, 1), (1, 3), (2, len(lines)), (len(lines) - 1, len(lines))]:
+            rendered = formatter.wrap_lines(highlighted.html_lines(start, stop, formatter),
+                                            first_line_number=start)
+            assert rendered == formatter.wrap_lines(lines[start:stop], first_line_number=start)
+            assert rendered in expected
+        assert HighlightedLines.from_json(highlighted.to_json()).html_lines(
+            0, len(highlighted), formatter) == lines
+
+def test_highlight_incrementally(tmpdir):
+    source = tmpdir.join('source')
+    source.join('package', 'module.py').write('x = 1\n', ensure=True)
+    source.join('package', 'data.bin').write_binary(b'\0\1\2', ensure=True)
+    source.join('README.txt').write('Read me\n')
+    source.join('setup.py').write('import os\n')
+    output = str(tmpdir.join('output'))
+    runner = click.testing.CliRunner()
+    def run_highlight():
+        result = runner.invoke(appraisal, ['highlight', str(source), output, '--jobs', '1'])
+        assert result.exit_code == 0, result.output
+        return result.output.strip()
+    def output_mtimes():
+        return {name: os.path.getmtime(os.path.join(output, name))
+                for name in ['package/module.py.html', 'README.txt.html', 'setup.py.html']}
+
+    assert run_highlight() == 'Highlighted 3 of 3 files into {}'.format(output)
+    files, skipped = read_manifest(os.path.join(output, '.highlight-manifest.json'))
+    assert sorted(files) == ['README.txt', 'package/module.py', 'setup.py']
+    assert list(skipped) == ['package/data.bin']
+    assert not os.path.exists(os.path.join(output, 'package/data.bin.html'))
+    mtimes = output_mtimes()
+
+    assert run_highlight() == 'Highlighted 0 of 3 files into {}'.format(output)
+    assert output_mtimes() == mtimes
+
+    source.join('package', 'module.py').write('x = 2\n')
+    assert run_highlight() == 'Highlighted 1 of 3 files into {}'.format(output)
+    changed = {name for name, mtime in output_mtimes().items() if mtime != mtimes[name]}
+    assert changed == {'package/module.py.html'}
+    with open(os.path.join(output, 'package/module.py.html'), encoding='utf-8') as html_file:
+        assert '2' in html_file.read()
+
+def test_has_long_line():
+    source = 'short\n' + 'x' * 10 + '\nshort'
+    assert has_long_line(source, 9)
+    assert not has_long_line(source, 10)
+    assert has_long_line(b'short\n' + b'x' * 11, 10)
+    assert not has_long_line('', 0)
+
+def test_line_mapping():
+    old_source = b'a\nb\nc\nd\n'
+    # A line inserted at the top, 'b' deleted and a line inserted before 'd'.
+    new_source = b'top\na\nc\ninserted\nd\n'
+    assert list(line_mapping(old_source, new_source)) == [1, 2, 2, 4]
+    assert list(line_mapping(old_source, b'')) == [0, 0, 0, 0]
+    # Leading blank lines are not displayed, so they are not numbered either.
+    assert list(line_mapping(b'\n\na = 1\nb = 2\n', b'\n\nx = 0\na = 1\nb = 2\n')) == [1, 2]
+    assert list(line_mapping(b'a\r\nb\r\n', b'a\nc\nb\n')) == [0, 2]
+
 @appraisal.command(
     'test',
     context_settings=dict(ignore_unknown_options=True, allow_extra_args=True)
@@ -1,39 +1,128 @@
 /* global $ showdown hljs Flask source_information */
 
-function delete_annotation(){
-    var $annotation = $(this).closest('.annotation');
-    var data = source_information;
-    data.line_number = $annotation.attr('code-line');
+function annotation_line_number($annotation){
+    // The annotation remembers the id of its code line, "code-line-N".
+    return parseInt($annotation.attr('code-line').replace('code-line-', ''), 10);
+}
+
+// Edits are not sent one at a time, instead they are queued here, keyed by line
+// number, and flushed together once the user pauses. A queued value of null
+// means the annotation on that line is to be deleted.
+var pending_edits = {};
+var flush_delay = 750;
+var flush_timer = null;
+var flush_in_flight = false;
+
+function has_pending_edits(){
+    return !$.isEmptyObject(pending_edits);
+}
+
+function update_pending_status(){
+    // Tests (and perhaps one day a status indicator) can wait on this.
+    var pending = has_pending_edits() || flush_in_flight;
+    $('body').toggleClass('annotations-pending', pending);
+}
+
+function schedule_flush(){
+    if (flush_timer !== null){
+        clearTimeout(flush_timer);
+    }
+    flush_timer = setTimeout(flush_edits, flush_delay);
+}
 
+function queue_edit(line_number, content){
+    pending_edits[line_number] = content;
+    update_pending_status();
+    schedule_flush();
+}
+
+function edits_batch(edits){
+    var batch = {
+        'repo_owner': source_information['repo_owner'],
+        'repo': source_information['repo'],
+        'filepath': source_information['filepath'],
+        'blob_sha': source_information['blob_sha'],
+        'upserts': [],
+        'deletes': []
+    };
+    $.each(edits, function(line_number, content){
+        line_number = parseInt(line_number, 10);
+        if (content === null){
+            batch['deletes'].push(line_number);
+        } else {
+            batch['upserts'].push({'line_number': line_number, 'content': content});
+        }
+    });
+    return batch;
+}
+
+function flush_edits(){
+    flush_timer = null;
+    if (flush_in_flight){
+        // Only one batch at a time so that an older batch can never overwrite
+        // a newer one, we try again once the current one has finished.
+        return;
+    }
+    if (!has_pending_edits()){
+        update_pending_status();
+        return;
+    }
+    var edits = pending_edits;
+    pending_edits = {};
+    flush_in_flight = true;
     $.ajax({type: "POST",
-      url: Flask.url_for('delete_annotation'),
-      data: data,
+      url: Flask.url_for('save_annotations'),
+      data: JSON.stringify(edits_batch(edits)),
+      contentType: 'application/json',
       success: function(data){
-          console.log('Successfully deleted the annotation');
-          $annotation.remove();
+          console.log('Successfully saved the annotations');
       },
       error: function(data){
           console.log('something went wrong');
+          // Put back any edits which have not since been superseded.
+          $.each(edits, function(line_number, content){
+              if (!(line_number in pending_edits)){
+                  pending_edits[line_number] = content;
+              }
+          });
+      },
+      complete: function(){
+          flush_in_flight = false;
+          if (has_pending_edits()){
+              schedule_flush();
+          }
+          update_pending_status();
       }
     });
 }
 
+function flush_edits_on_unload(){
+    if (!has_pending_edits()){
+        return;
+    }
+    var batch = JSON.stringify(edits_batch(pending_edits));
+    pending_edits = {};
+    var url = Flask.url_for('save_annotations');
+    if (navigator.sendBeacon){
+        navigator.sendBeacon(url, new Blob([batch], {type: 'application/json'}));
+    } else {
+        $.ajax({type: "POST", url: url, data: batch,
+                contentType: 'application/json', async: false});
+    }
+}
+
+function delete_annotation(){
+    var $annotation = $(this).closest('.annotation');
+    queue_edit(annotation_line_number($annotation), null);
+    $annotation.remove();
+}
+
 function save_annotation(){
     var textarea = this;
     var $annotation = $(textarea).closest('.annotation');
-    var data = source_information;
-    data.line_number = $annotation.attr('code-line');
-    data.content = textarea.value;
-    $.ajax({type: "POST",
-      url: Flask.url_for('save_annotation'),
-      data: data,
-      success: function(data){
-          console.log('Successfully saved the annotation');
-      },
-      error: function(data){
-          console.log('something went wrong');
-      }
-    });
+    if (textarea.value){
+        queue_edit(annotation_line_number($annotation), textarea.value);
+    }
 }
 
 function process_annotation_output($annot_input, $annot_output){
@@ -47,7 +136,7 @@ function process_annotation_output($annot_input, $annot_output){
 }
 
 
-function add_annotation($code_line, content, focus_annot_textarea){
+function add_annotation($code_line, content, focus_annot_textarea, content_html){
     var $annotation = $('\
         <div class="annotation">\
             <div class="annotation-toolbar">\
@@ -59,21 +148,27 @@ function add_annotation($code_line, content, focus_annot_textarea){
         </div>');
     $code_line.before($annotation);
     $annotation.attr('code-line', $code_line.attr('id'));
+    $annotation.find('.annotation-input').val(content);
+    // The server renders the content of stored annotations for us.
+    $annotation.find('.annotation-output').html(content_html || '');
+    setup_annotation($annotation, focus_annot_textarea);
+}
+
+function setup_annotation($annotation, focus_annot_textarea){
+    // Annotations are usually rendered inline by the server, in which case
+    // this is all we have to do for them.
     $annotation.find('.delete-annotation').click(delete_annotation);
     var $annot_input = $annotation.find('.annotation-input');
-    $annot_input.val(content);
     if (focus_annot_textarea){
         $annot_input.focus();
     }
     var $annot_output = $annotation.find('.annotation-output');
 
-    // Set up the keyup event to format the common-mark into HTML
+    // Set up the keyup event to format the common-mark into HTML, this is
+    // only a preview, the server renders the content once it is saved.
     $annot_input.keyup(function(){
         process_annotation_output($annot_input, $annot_output);
     });
-    // Trigger that event immediately, we could skip this if 'content' is
-    // blank (in particular for a 'new_annotation').
-    $annot_input.trigger('keyup');
     $annot_input.keydown(function(event){
         event.stopPropagation();
         var keyCode = event.keyCode || event.which;
@@ -132,8 +227,9 @@ function get_annotations(){
       data: source_information,
       success: function(data){
           $.each(data['annotations'], function(index, annotation){
-            var $code_line = $('#' + annotation['line_number']);
-            add_annotation($code_line, annotation['content'], false);
+            var $code_line = $('#code-line-' + annotation['line_number']);
+            add_annotation($code_line, annotation['content'], false,
+                           annotation['content_html']);
           });
       },
       error: function(data){
@@ -142,10 +238,117 @@ function get_annotations(){
     });
 }
 
+function refresh_annotations(){
+    $('.annotation').remove();
+    get_annotations();
+}
+
 function add_new_annotation(){
     add_annotation($(this), "", true);
 }
 
+// For very large files the page only holds a window of the lines, we load more
+// as the user scrolls towards either end, and drop lines from the far end so
+// that the size of the page stays bounded.
+var source_window = source_information['window'];
+var window_chunk_lines = 250;
+var window_max_lines = 1500;
+var window_loading = false;
+var window_margin_pixels = 1500;
+
+function add_window_lines(html, where){
+    var $lines = $(html);
+    var $source_lines = $('#source-lines');
+    if (where === 'before'){
+        var old_height = $source_lines.height();
+        $source_lines.prepend($lines);
+        // Keep whatever the user is looking at in the same place.
+        window.scrollBy(0, $source_lines.height() - old_height);
+    } else {
+        $source_lines.append($lines);
+    }
+    $lines.filter('.annotation').each(function(){
+        setup_annotation($(this), false);
+    });
+}
+
+function trim_window(where){
+    // Remove lines from the opposite end to 'where' lines were just added.
+    var excess = (source_window.stop - source_window.start) - window_max_lines;
+    if (excess <= 0){
+        return;
+    }
+    var $lines = $('#source-lines > .code-line-container');
+    var $removed = where === 'before' ? $lines.slice(-excess) : $lines.slice(0, excess);
+    // Any annotations belong to the following line, so go with it.
+    var $annotations = $removed.prevUntil('.code-line-container', '.annotation');
+    if ($removed.add($annotations).find(':focus').length){
+        return;
+    }
+    var $source_lines = $('#source-lines');
+    var old_height = $source_lines.height();
+    $annotations.remove();
+    $removed.remove();
+    if (where === 'before'){
+        source_window.stop -= excess;
+    } else {
+        source_window.start += excess;
+        window.scrollBy(0, $source_lines.height() - old_height);
+    }
+}
+
+function load_window_lines(where){
+    var start = null;
+    var stop = null;
+    if (where === 'before'){
+        stop = source_window.start;
+        start = Math.max(0, stop - window_chunk_lines);
+    } else {
+        start = source_window.stop;
+        stop = Math.min(source_window.num_lines, start + window_chunk_lines);
+    }
+    if (window_loading || start >= stop){
+        return;
+    }
+    window_loading = true;
+    $.ajax({type: "GET",
+      url: Flask.url_for('source_lines', {
+          'owner': source_information['repo_owner'],
+          'repo': source_information['repo'],
+          'filepath': source_information['filepath']
+      }),
+      data: {'start': start, 'stop': stop},
+      success: function(data){
+          add_window_lines(data['html'], where);
+          if (where === 'before'){
+              source_window.start = data['start'];
+          } else {
+              source_window.stop = data['stop'];
+          }
+          trim_window(where);
+      },
+      error: function(data){
+          console.log('something went wrong');
+      },
+      complete: function(){
+          window_loading = false;
+      }
+    });
+}
+
+function check_window_edges(){
+    var scroll_top = $(window).scrollTop();
+    var scroll_bottom = scroll_top + $(window).height();
+    var $source_lines = $('#source-lines');
+    var lines_top = $source_lines.offset().top;
+    var lines_bottom = lines_top + $source_lines.height();
+    if (scroll_bottom + window_margin_pixels > lines_bottom){
+        load_window_lines('after');
+    } else if (scroll_top - window_margin_pixels < lines_top){
+        load_window_lines('before');
+    }
+}
+
 function activate_line(line){
     var line_number = "#code-line-" + line;
     $('.code-line-container').removeClass('active-line');
@@ -205,8 +408,24 @@ function document_key_press(event){
 }
 
 $(document).ready(function(){
-    $('.code-line-container').click(add_new_annotation);
-    get_annotations();
-    activate_line(0); // Assumes there is at least one line.
+    // Delegated, as lines may be loaded later in windowed mode.
+    $('#source-lines').on('click', '.code-line-container', add_new_annotation);
+    $('.annotation').each(function(){
+        setup_annotation($(this), false);
+    });
+    if (source_information['fetch_annotations']){
+        get_annotations();
+    }
+    $('#refresh-annotations').click(function(event){
+        event.preventDefault();
+        refresh_annotations();
+    });
+    if (source_window){
+        $(window).scroll(check_window_edges);
+        activate_line(source_window.start);
+    } else {
+        activate_line(0); // Assumes there is at least one line.
+    }
     $(document).keydown(document_key_press);
+    $(window).on('beforeunload', flush_edits_on_unload);
 });
\ No newline at end of file
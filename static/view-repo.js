@@ -0,0 +1,85 @@
+/* global $ Flask repo_information */
+
+function source_file_link(entry){
+    var $link = $('<a class="source-file-link"></a>');
+    $link.attr('path', entry['path']);
+    $link.attr('href', Flask.url_for('view_source', {
+        'owner': repo_information['owner'],
+        'repo': repo_information['repo_name'],
+        'filepath': entry['path']
+    }));
+    $link.text(entry['name']);
+    return $link;
+}
+
+function directory_link(entry){
+    var $link = $('<a class="directory-link"></a>');
+    $link.attr('path', entry['path']);
+    $link.attr('href', Flask.url_for('view_repo', {
+        'owner': repo_information['owner'],
+        'repo_name': repo_information['repo_name'],
+        'path': entry['path']
+    }));
+    $link.text(entry['name'] + '/');
+    $link.click(toggle_directory);
+    return $link;
+}
+
+function load_directory_page($list, path, page){
+    var data = {'path': path, 'page': page};
+    $.ajax({type: "GET",
+      url: Flask.url_for('repo_directory', {
+          'owner': repo_information['owner'],
+          'repo_name': repo_information['repo_name']
+      }),
+      data: data,
+      success: function(data){
+          var directory = data['directory'];
+          $.each(directory['entries'], function(index, entry){
+              var $item = $('<li></li>');
+              if (entry['type'] === 'tree'){
+                  $item.append(directory_link(entry));
+              } else if (entry['type'] === 'blob'){
+                  $item.append(source_file_link(entry));
+              }
+              if (entry['annotation_count']){
+                  var $count = $('<span class="annotation-count" title="annotations"></span>');
+                  $count.text(entry['annotation_count']);
+                  $item.append(' ').append($count);
+              }
+              $list.append($item);
+          });
+          if (directory['page'] < directory['num_pages']){
+              var $more = $('<li><a class="more-entries" href="#">more...</a></li>');
+              $more.find('a').click(function(event){
+                  event.preventDefault();
+                  $more.remove();
+                  load_directory_page($list, path, directory['page'] + 1);
+              });
+              $list.append($more);
+          }
+      },
+      error: function(data){
+          console.log('something went wrong');
+      }
+    });
+}
+
+function toggle_directory(event){
+    // Expand the directory in place rather than navigating to it, the link
+    // still works as a normal link if opened in a new tab.
+    event.preventDefault();
+    var $link = $(this);
+    var $children = $link.siblings('.directory-children');
+    if ($children.length){
+        $children.toggle();
+        return;
+    }
+    $children = $('<ul class="directory-children"></ul>');
+    $link.after($children);
+    load_directory_page($children, $link.attr('path'), 1);
+}
+
+$(document).ready(function(){
+    $('#repo-directory .directory-link').click(toggle_directory);
+});